@@ -0,0 +1,156 @@
+"""Нагрузочный стенд: бот против локальных заглушек Telegram Bot API и Roblox.
+
+    python bench.py --accounts 200 --rate 100 --duration 20 --chats 50 --sizes 10,50,100
+
+Гоняет /signal через приложение из main.build_app() и печатает p50/p99 задержки heartbeat'ов,
+время check_timeouts и refresh_panels, время и память generate_status_pages (пик Python-аллокаций и max RSS процесса, куда попадают буферы Pillow) по числу аккаунтов.
+"""
+import os, io, time, json, random, asyncio, argparse, logging, resource, tracemalloc
+from aiohttp import web, ClientSession, TCPConnector
+from PIL import Image
+
+TG_PORT, RBX_PORT, BOT_PORT = 18081, 18082, 18083
+FAKE = f"http://127.0.0.1:{RBX_PORT}"
+
+# main.py читает окружение при импорте, поэтому заглушки прописываем до него
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{TG_PORT}"
+os.environ["ROBLOX_USERS_URL"] = f"{FAKE}/v1/usernames/users"
+os.environ["ROBLOX_THUMBS_URL"] = f"{FAKE}/v1/users/avatar-headshot"
+os.environ.pop("REDIS_URL", None)
+import main as bss
+
+logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+
+def _png(size, color):
+    buf = io.BytesIO(); Image.new("RGBA", size, color).save(buf, format="PNG"); return buf.getvalue()
+
+# --- Заглушки ---
+def fake_telegram(stats):
+    """Отвечает на любой метод Bot API как на успешный; считает вызовы по методам."""
+    async def handle(request):
+        method = request.match_info["method"]; data = await request.post()
+        stats[method] = stats.get(method, 0) + 1
+        chat_id = int(data.get("chat_id") or 1)
+        msg = {"message_id": random.randint(1, 10**6), "date": int(time.time()), "chat": {"id": chat_id, "type": "group", "title": "bench"}}
+        return web.json_response({"ok": True, "result": True if method in ("deleteWebhook", "deleteMessage") else msg})
+    app = web.Application(); app.router.add_post("/bot{token}/{method}", handle)
+    return app
+
+def fake_roblox():
+    avatar, background = _png((150, 150), (200, 120, 40, 255)), _png((1920, 1080), (20, 60, 90, 255))
+    async def users(request):
+        names = (await request.json())["usernames"]
+        return web.json_response({"data": [{"requestedUsername": n, "id": 1000 + i, "name": n} for i, n in enumerate(names)]})
+    async def thumbs(request):
+        ids = request.query["userIds"].split(",")
+        return web.json_response({"data": [{"targetId": int(i), "state": "Completed", "imageUrl": f"{FAKE}/img/{i}.png"} for i in ids]})
+    async def img(request): return web.Response(body=avatar, content_type="image/png")
+    async def bg(request): return web.Response(body=background, content_type="image/png")
+    app = web.Application()
+    app.router.add_post("/v1/usernames/users", users); app.router.add_get("/v1/users/avatar-headshot", thumbs)
+    app.router.add_get("/img/{uid}.png", img); app.router.add_get("/bg.png", bg)
+    return app
+
+async def serve(app, port):
+    runner = web.AppRunner(app); await runner.setup(); await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+# --- Замеры ---
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] * 1000 if values else 0.0
+
+async def drive_signals(n_accounts, rate, duration):
+    """Шлёт heartbeat'ы с заданной общей частотой, каждый аккаунт по кругу; возвращает задержки."""
+    names = [f"Bee{i:04d}" for i in range(n_accounts)]
+    latencies, errors, sent = [], 0, 0
+    url = f"http://127.0.0.1:{BOT_PORT}/signal"
+    async with ClientSession(connector=TCPConnector(limit=64)) as s:
+        async def one(u):
+            nonlocal errors
+            payload = {"username": u, "honey": random.randint(10**6, 10**9), "pollen": random.randint(0, 100), "capacity": 100}
+            t = time.perf_counter()
+            try:
+                async with s.post(url, json=payload) as r:
+                    await r.read()
+                    if r.status != 200: errors += 1
+            except Exception: errors += 1
+            latencies.append(time.perf_counter() - t)
+        tasks, start = [], time.perf_counter()
+        while time.perf_counter() - start < duration:
+            tasks.append(asyncio.ensure_future(one(names[sent % n_accounts]))); sent += 1
+            await asyncio.sleep(max(0, start + sent / rate - time.perf_counter()))
+        await asyncio.gather(*tasks)
+    return latencies, errors, sent, time.perf_counter() - start
+
+async def time_it(coro_fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter(); await coro_fn(); best = min(best, time.perf_counter() - t)
+    return best * 1000
+
+async def bench_check_timeouts():
+    """Прогоняет массовый вылет: все аккаунты разом просрочены."""
+    for u in bss.accounts: bss.accounts[u] -= bss.check_timeout + 1
+    bss.reschedule_all()
+    t = time.perf_counter(); await bss.check_timeouts(); return (time.perf_counter() - t) * 1000
+
+async def bench_refresh_panels(n_chats):
+    bss.status_messages.clear(); bss.panel_hashes.clear()
+    for i in range(n_chats): bss.status_messages[str(-100 - i)] = i + 1
+    bss.rebuild_fleets()
+    t = time.perf_counter(); await bss.refresh_panels(); cold = (time.perf_counter() - t) * 1000
+    t = time.perf_counter(); await bss.refresh_panels(); warm = (time.perf_counter() - t) * 1000
+    return cold, warm
+
+async def bench_render(n):
+    names = [f"Bee{i:04d}" for i in range(n)]
+    for u in names:
+        bss.accounts.setdefault(u, time.time()); bss.start_times.setdefault(u, time.time())
+        bss.acc_stats[u] = {"h": "1.0M", "prof": "0.0", "raw_prof": 0, "b": "50%", "raw_b": 50}
+    rows = []
+    for label in ("cold", "warm"):
+        tracemalloc.start(); t = time.perf_counter()
+        pages = await bss.generate_status_pages(names)
+        ms = (time.perf_counter() - t) * 1000; peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        rows.append((label, ms, peak / 2**20, rss, sum(len(p) for p, _ in pages) / 2**10, len(pages), pages[0][1]))
+    return rows
+
+async def run(args):
+    tg_stats = {}
+    runners = [await serve(fake_telegram(tg_stats), TG_PORT), await serve(fake_roblox(), RBX_PORT), await serve(bss.build_app(), BOT_PORT)]
+    bss.BG_URLS[:] = [f"{FAKE}/bg.png"]
+    workers = [asyncio.ensure_future(bss.outbox_worker()) for _ in range(bss.OUTBOX_WORKERS)]
+    try:
+        print(f"== /signal: {args.accounts} аккаунтов, {args.rate}/с, {args.duration}с")
+        lat, errors, sent, took = await drive_signals(args.accounts, args.rate, args.duration)
+        print(f"  sent={sent} achieved={sent / took:.0f}/s errors={errors} p50={pct(lat, 50):.2f}ms p99={pct(lat, 99):.2f}ms max={pct(lat, 100):.2f}ms")
+
+        print(f"== refresh_panels: {args.chats} чатов")
+        cold, warm = await bench_refresh_panels(args.chats)
+        print(f"  changed={cold:.0f}ms unchanged={warm:.2f}ms")
+
+        print(f"== check_timeouts: {len(bss.accounts)} аккаунтов")
+        idle = await time_it(bss.check_timeouts, repeat=5)
+        print(f"  idle={idle:.3f}ms mass_expiry={await bench_check_timeouts():.2f}ms")
+
+        print("== generate_status_pages")
+        for n in args.sizes:
+            for label, ms, peak, rss, kb, n_pages, fmt in await bench_render(n):
+                print(f"  n={n:<4} {label:<5} {ms:8.1f}ms py_peak={peak:6.1f}MiB max_rss={rss:7.1f}MiB {n_pages}x{fmt} {kb:7.1f}KiB")
+        print(f"== Telegram API вызовы: {json.dumps(tg_stats, sort_keys=True)}")
+    finally:
+        for w in workers: w.cancel()
+        for r in runners: await r.cleanup()
+        await bss.bot.session.close()
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--accounts", type=int, default=100)
+    p.add_argument("--rate", type=float, default=50, help="heartbeat'ов в секунду на все аккаунты")
+    p.add_argument("--duration", type=float, default=10)
+    p.add_argument("--chats", type=int, default=20)
+    p.add_argument("--sizes", type=lambda v: [int(x) for x in v.split(",")], default=[10, 50, 100])
+    asyncio.run(run(p.parse_args()))
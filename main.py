@@ -1,8 +1,15 @@
-import os, asyncio, time, json, random, logging, sys, io, aiohttp, datetime
+import os, asyncio, time, json, random, logging, sys, io, aiohttp, datetime, base64, hashlib, heapq, itertools, threading, cProfile, pstats, tracemalloc
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, timezone
 import redis.asyncio as redis
 from PIL import Image, ImageDraw, ImageFont
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
 from aiogram.filters import Command
 from aiogram.types import (
     InlineKeyboardMarkup, 
@@ -10,6 +17,8 @@ from aiogram.types import (
     BufferedInputFile, 
     InlineQuery, 
     InlineQueryResultArticle, 
+    InlineQueryResultCachedPhoto,
+    InputMediaPhoto,
     InputTextMessageContent
 )
 from aiogram.fsm.state import StatesGroup, State
@@ -25,18 +34,26 @@ ALLOWED_ADMIN = "Gold_mod1"
 DB_KEY = "BSS_GLOBAL_DATABASE_PRO" 
 FONT_PATH = "roboto_font.ttf"
 FONT_URL = "https://cdn.jsdelivr.net/gh/googlefonts/roboto@main/src/hinted/Roboto-Bold.ttf"
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # свой Bot API сервер (или заглушка из bench.py)
+ROBLOX_USERS_URL = os.getenv("ROBLOX_USERS_URL", "https://users.roblox.com/v1/usernames/users")
+ROBLOX_THUMBS_URL = os.getenv("ROBLOX_THUMBS_URL", "https://thumbnails.roblox.com/v1/users/avatar-headshot")
+AVATAR_SIZE = (85, 85)
+AVATAR_TTL = int(os.getenv("AVATAR_TTL", 6 * 3600))
+AVATAR_CONCURRENCY = 8
+AVATAR_DIR = "avatar_cache"
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s', handlers=[logging.StreamHandler(sys.stdout)])
 logger = logging.getLogger("BSS_PRO")
 
-bot = Bot(token=TOKEN)
+bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None)
 dp = Dispatcher()
 db = None
 
 # Глобальные данные
 accounts, start_times, notifications, status_messages = {}, {}, {}, {}
 pause_data, acc_stats = {}, {}
-initial_honey, action_logs = {}, []
+fleets = {}  # чат -> за какими аккаунтами следит; чата нет в словаре — следит за всем ульем
+initial_honey = {}
 total_restarts, session_restarts = 0, 0
 
 # НОВЫЕ ПЕРЕМЕННЫЕ АДМИНКИ
@@ -46,6 +63,13 @@ custom_backgrounds = []
 active_bg = None
 
 BG_URLS = ["https://wallpaperaccess.com/full/7500647.png", "https://wallpaperaccess.com/full/14038208.jpg"]
+IMG_WIDTH, ROW_H, HEAD_H, FOOT_H = 750, 115, 130, 80
+GRID_MIN, IMG_COLS, ROWS_PER_COL = 10, 2, 10  # больше GRID_MIN аккаунтов — сетка 2x10 на страницу
+IMG_FORMAT = os.getenv("IMG_FORMAT", "auto")   # auto | png | jpeg | webp
+IMG_QUALITY = int(os.getenv("IMG_QUALITY", 85))
+IMG_TARGET_BYTES = int(os.getenv("IMG_TARGET_BYTES", 1_500_000))
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", 2))
+RENDER_QUEUE = int(os.getenv("RENDER_QUEUE", 8))
 
 class PostCreation(StatesGroup): waiting_for_title = State(); waiting_for_text = State(); waiting_for_photo = State(); confirming = State()
 class TechPause(StatesGroup): choosing_target = State(); entering_time = State(); choosing_mode = State()
@@ -62,10 +86,39 @@ def format_honey(n):
         return f"{n:.1f}Q"
     except: return "0"
 
-def add_log(text):
+# --- Журнал событий ---
+# С Redis журнал — capped stream DB_KEY:eventlog плюс индексные стримы по аккаунту и типу события
+# (eventlog:acc:<ник>, eventlog:kind:<тип>): запись — O(1) XADD, /logs с фильтром читает один индекс.
+# Без Redis то же самое живёт в памяти ограниченными очередями.
+LOG_CAP = int(os.getenv("LOG_CAP", 10000))
+LOG_INDEX_CAP = int(os.getenv("LOG_INDEX_CAP", 1000))
+LOG_PAGE = 10
+LOG_KINDS = {"login": "🟢 Входы", "disconnect": "🔴 Вылеты", "pause": "🛠 Паузы", "admin": "👑 Админ", "system": "⚙️ Система"}
+event_log = deque(maxlen=LOG_CAP)  # журнал в памяти (режим без Redis)
+log_index = {}                     # "acc:<ник>" / "kind:<тип>" -> deque событий
+log_seq = itertools.count(1)
+
+def _log_keys(ev):
+    return [f"kind:{ev['kind']}"] + ([f"acc:{ev['acc']}"] if ev["acc"] else [])
+
+def add_log(text, kind="system", acc=None):
     now = datetime.datetime.now(timezone(timedelta(hours=2))).strftime("%H:%M:%S")
-    action_logs.insert(0, f"🕒 <code>{now}</code> — {text}")
-    if len(action_logs) > 10: action_logs.pop()
+    ev = {"ts": f"{time.time():.0f}", "text": f"🕒 <code>{now}</code> — {text}", "kind": kind, "acc": acc or ""}
+    if REDIS_URL: pending_logs.append(ev); mark_dirty("logs", "new"); return
+    ev["id"] = next(log_seq); event_log.append(ev)
+    for k in _log_keys(ev): log_index.setdefault(k, deque(maxlen=LOG_INDEX_CAP)).append(ev)
+
+FONT_SIZES = (42, 28, 18, 16)
+_fonts = threading.local()
+
+def get_fonts():
+    """Размер -> шрифт. Грузится один раз на поток рендера (FreeType-объекты лучше не делить между потоками);
+    пока файла шрифта нет, отдаём встроенный и не кэшируем, чтобы подхватить Roboto после загрузки."""
+    fonts = getattr(_fonts, "by_size", None)
+    if fonts is None:
+        try: fonts = _fonts.by_size = {size: ImageFont.truetype(FONT_PATH, size) for size in FONT_SIZES}
+        except Exception: swallowed("font"); fonts = dict.fromkeys(FONT_SIZES, ImageFont.load_default())
+    return fonts
 
 async def download_font():
     if not os.path.exists(FONT_PATH):
@@ -74,115 +127,995 @@ async def download_font():
                 async with s.get(FONT_URL) as r:
                     if r.status == 200:
                         with open(FONT_PATH, "wb") as f: f.write(await r.read())
-        except: pass
-
-async def get_avatar(username, session):
+        except Exception: swallowed("download_font")
+
+# --- Метрики ---
+# Минимальный экспорт в текстовом формате Prometheus, без внешних зависимостей.
+metrics_registry = []
+
+class Metric:
+    def __init__(self, name, doc, kind):
+        self.name, self.doc, self.kind, self.values = name, doc, kind, {}
+        metrics_registry.append(self)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = tuple(sorted(labels.items())) + tuple(extra)
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}" if items else ""
+
+    def lines(self):
+        for labels, v in self.values.items(): yield f"{self.name}{self._labels(dict(labels))} {v}"
+
+class Counter(Metric):
+    def __init__(self, name, doc): super().__init__(name, doc, "counter")
+    def inc(self, v=1, **labels):
+        key = tuple(sorted(labels.items())); self.values[key] = self.values.get(key, 0) + v
+
+class Gauge(Metric):
+    def __init__(self, name, doc, fn=None):
+        super().__init__(name, doc, "gauge"); self.fn = fn
+    def set(self, v, **labels): self.values[tuple(sorted(labels.items()))] = v
+    def lines(self):
+        if self.fn: self.values[()] = self.fn()
+        yield from super().lines()
+
+class Histogram(Metric):
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    def __init__(self, name, doc, buckets=BUCKETS, slow=None):
+        super().__init__(name, doc, "histogram"); self.buckets, self.slow = buckets, slow  # slow — метка для журнала медленных вызовов
+
+    def observe(self, v, **labels):
+        key = tuple(sorted(labels.items()))
+        h = self.values.get(key)
+        if h is None: h = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, b in enumerate(self.buckets):
+            if v <= b: h[0][i] += 1
+        h[1] += v; h[2] += 1
+
+    def time(self, **labels): return _Timer(self, labels)
+
+    def lines(self):
+        for key, (counts, total, n) in self.values.items():
+            labels = dict(key)
+            for b, c in zip(self.buckets, counts): yield f"{self.name}_bucket{self._labels(labels, [('le', b)])} {c}"
+            yield f"{self.name}_bucket{self._labels(labels, [('le', '+Inf')])} {n}"
+            yield f"{self.name}_sum{self._labels(labels)} {total}"
+            yield f"{self.name}_count{self._labels(labels)} {n}"
+
+class _Timer:
+    def __init__(self, hist, labels): self.hist, self.labels = hist, labels
+    def __enter__(self): self.t = time.perf_counter(); return self
+    def __exit__(self, *exc):
+        dt = time.perf_counter() - self.t; self.hist.observe(dt, **self.labels)
+        if self.hist.slow: note_call(self.hist.slow, self.labels, dt)
+
+class RateMeter:
+    """Скользящая частота событий за window секунд по посекундным корзинам."""
+    def __init__(self, window=60):
+        self.window, self.slots = window, [0] * window; self.sec = int(time.time())
+    def _roll(self, now):
+        sec = int(now)
+        for s in range(self.sec + 1, min(sec, self.sec + self.window) + 1): self.slots[s % self.window] = 0
+        self.sec = max(self.sec, sec)
+    def hit(self, n=1):
+        self._roll(time.time()); self.slots[self.sec % self.window] += n
+    def rate(self):
+        self._roll(time.time()); return sum(self.slots) / self.window
+
+heartbeat_meter = RateMeter()
+M_HEARTBEATS = Counter("bss_heartbeats_total", "Принятые heartbeat'ы")
+M_HEARTBEAT_ERRORS = Counter("bss_heartbeat_errors_total", "Отклонённые heartbeat'ы по причине")
+M_HEARTBEAT_RATE = Gauge("bss_heartbeat_rate", "Heartbeat'ов в секунду за последнюю минуту", heartbeat_meter.rate)
+M_SIGNAL_SECONDS = Histogram("bss_signal_request_seconds", "Время обработки запросов /signal*")
+M_TIMEOUTS_SECONDS = Histogram("bss_check_timeouts_seconds", "Длительность тика check_timeouts", slow="check_timeouts")
+M_SAVE_SECONDS = Histogram("bss_save_seconds", "Длительность сброса состояния в Redis", slow="save")
+M_SAVE_BYTES = Gauge("bss_save_bytes", "Объём последнего сброса в Redis, байт")
+M_TG_SECONDS = Histogram("bss_telegram_request_seconds", "Время запросов к Telegram Bot API", slow="telegram")
+M_TG_ERRORS = Counter("bss_telegram_errors_total", "Ошибки Telegram Bot API")
+M_RENDER_SECONDS = Histogram("bss_render_seconds", "Время рендера картинок", slow="render")
+M_HANDLER_SECONDS = Histogram("bss_handler_seconds", "Время обработки апдейтов Telegram по хендлерам", slow="handler")
+M_HTTP_SECONDS = Histogram("bss_http_seconds", "Время обработки HTTP-запросов по маршрутам", slow="http")
+M_LOOP_STALLS = Counter("bss_loop_stalls_total", "Зависания event loop дольше LOOP_STALL_WARN")
+M_CACHE = Counter("bss_cache_requests_total", "Обращения к кэшам: hit / miss")
+M_SWALLOWED = Counter("bss_swallowed_exceptions_total", "Проглоченные исключения по месту")
+
+def swallowed(where):
+    """Вместо молчаливого except: pass — считаем и пишем в debug-лог."""
+    M_SWALLOWED.inc(where=where); logger.debug("swallowed in %s", where, exc_info=True)
+
+# Цикл держит на задачу только слабую ссылку: фоновые задачи без своего владельца храним здесь,
+# иначе GC может собрать их посреди работы.
+background_tasks = set()
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task); task.add_done_callback(background_tasks.discard)
+    return task
+
+def render_metrics():
+    out = []
+    for m in metrics_registry:
+        out += [f"# HELP {m.name} {m.doc}", f"# TYPE {m.name} {m.kind}"]; out += list(m.lines())
+    return "\n".join(out) + "\n"
+
+class TelegramMetrics(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        with M_TG_SECONDS.time(method=name):
+            try: return await make_request(bot, method)
+            except Exception as e: M_TG_ERRORS.inc(method=name, error=type(e).__name__); raise
+
+bot.session.middleware(TelegramMetrics())
+
+async def handle_metrics(request):
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+# --- Медленные вызовы и профилирование ---
+# Всё, что меряется гистограммой со slow=..., плюс хендлеры бота и HTTP-маршруты: вызовы дольше
+# SLOW_CALL_MS попадают в скользящий журнал, из которого считается топ нарушителей.
+SLOW_CALL_MS = float(os.getenv("SLOW_CALL_MS", 500))
+LOOP_STALL_WARN = float(os.getenv("LOOP_STALL_WARN", 0.5))  # секунд без возврата в event loop
+slow_calls = deque(maxlen=500)  # (время, что, сколько мс)
+profiling = asyncio.Lock()      # cProfile и tracemalloc не вкладываются: один замер за раз
+profile_tasks = set()
+
+def note_call(kind, labels, seconds):
+    if seconds * 1000 < SLOW_CALL_MS: return
+    name = ":".join([kind, *map(str, labels.values())])
+    slow_calls.append((time.time(), name, seconds * 1000)); logger.warning("Медленно: %s %.0f мс", name, seconds * 1000)
+
+def slow_report(top=10):
+    """Топ медленных мест по суммарному времени за окно журнала."""
+    agg = {}
+    for _, name, ms in slow_calls:
+        a = agg.setdefault(name, [0, 0.0, 0.0]); a[0] += 1; a[1] += ms; a[2] = max(a[2], ms)
+    rows = sorted(agg.items(), key=lambda kv: -kv[1][1])[:top]
+    return "\n".join(f"{name}: {n}× всего {total:.0f} мс, макс {peak:.0f} мс" for name, (n, total, peak) in rows)
+
+class HandlerTiming(BaseMiddleware):
+    """Outer-middleware на апдейты: время всего апдейта, имя хендлера подставляет _name_handler."""
+    async def __call__(self, handler, event, data):
+        timing = data["timing"] = {"name": event.event_type}
+        t = time.perf_counter()
+        try: return await handler(event, data)
+        finally:
+            dt = time.perf_counter() - t; M_HANDLER_SECONDS.observe(dt, handler=timing["name"]); note_call("handler", timing, dt)
+
+async def _name_handler(handler, event, data):
+    if "timing" in data: data["timing"]["name"] = data["handler"].callback.__name__
+    return await handler(event, data)
+
+dp.update.outer_middleware(HandlerTiming())
+for observer in (dp.message, dp.callback_query, dp.inline_query): observer.middleware(_name_handler)
+
+@web.middleware
+async def http_timing(request, handler):
+    route = request.match_info.route.resource.canonical if request.match_info.route.resource else "unmatched"
+    if route == "/signal/stream": return await handler(request)  # долгоживущий поток, не медленный запрос
+    with M_HTTP_SECONDS.time(route=route): return await handler(request)
+
+async def loop_watchdog(interval=0.1):
+    """Сколько event loop опоздал к нашему таймеру — столько он был занят чем-то синхронным."""
+    while True:
+        t = time.perf_counter(); await asyncio.sleep(interval)
+        lag = time.perf_counter() - t - interval
+        if lag >= LOOP_STALL_WARN:
+            M_LOOP_STALLS.inc(); slow_calls.append((time.time(), "loop:stall", lag * 1000))
+            logger.warning("Event loop завис на %.0f мс", lag * 1000)
+
+async def profile_cpu(seconds):
+    """cProfile всего, что крутится в event loop за seconds (потоки рендера сюда не попадают)."""
+    prof = cProfile.Profile(); prof.enable()
+    try: await asyncio.sleep(seconds)
+    finally: prof.disable()
+    out = io.StringIO()
+    for key in ("cumulative", "tottime"):
+        out.write(f"=== По {key} ===\n"); pstats.Stats(prof, stream=out).strip_dirs().sort_stats(key).print_stats(30)
+    return out.getvalue()
+
+async def profile_memory(seconds):
+    """Прирост аллокаций за seconds и самые большие держатели памяти по строкам."""
+    started = not tracemalloc.is_tracing()
+    if started: tracemalloc.start(10)
     try:
-        async with session.post("https://users.roblox.com/v1/usernames/users", json={"usernames": [username], "excludeBannedUsers": False}) as resp:
-            uid = (await resp.json())["data"][0]["id"]
-        url = f"https://thumbnails.roblox.com/v1/users/avatar-headshot?userIds={uid}&size=150x150&format=Png&isCircular=true"
-        async with session.get(url) as resp: img_url = (await resp.json())["data"][0]["imageUrl"]
-        async with session.get(img_url) as resp: return Image.open(io.BytesIO(await resp.read())).convert("RGBA")
-    except: return None
+        before = tracemalloc.take_snapshot(); await asyncio.sleep(seconds); after = tracemalloc.take_snapshot()
+    finally:
+        if started: tracemalloc.stop()
+    lines = ["=== Прирост за замер ==="] + [str(st) for st in after.compare_to(before, "lineno")[:30]]
+    lines += ["", "=== Крупнейшие держатели ==="] + [str(st) for st in after.statistics("lineno")[:20]]
+    return "\n".join(lines)
+
+async def send_profile(chat_id, mode, seconds):
+    try:
+        async with profiling:
+            report = await (profile_cpu if mode == "cpu" else profile_memory)(seconds)
+        head = f"BSS {VERSION} — {'cProfile' if mode == 'cpu' else 'tracemalloc'} за {seconds} с\n\n=== Медленные вызовы ===\n{slow_report() or 'нет'}\n\n"
+        await bot.send_document(chat_id, BufferedInputFile((head + report).encode(), filename=f"profile_{mode}_{int(time.time())}.txt"))
+    except Exception as e:
+        swallowed("send_profile")
+        try: await bot.send_message(chat_id, f"❌ Замер не удался: {type(e).__name__}")
+        except Exception: swallowed("send_profile_report")
+
+def start_profile(chat_id, mode, seconds):
+    task = asyncio.create_task(send_profile(chat_id, mode, seconds))
+    profile_tasks.add(task); task.add_done_callback(profile_tasks.discard)
+
+# --- Аватарки ---
+class TTLCache:
+    """LRU-кэш в памяти: вытесняет самые старые записи и забывает просроченные."""
+    def __init__(self, maxsize, ttl):
+        self.maxsize, self.ttl, self.data = maxsize, ttl, OrderedDict()
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None: return default
+        if item[0] < time.time(): self.data.pop(key, None); return default
+        self.data.move_to_end(key); return item[1]
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = (time.time() + (ttl or self.ttl), value); self.data.move_to_end(key)
+        while len(self.data) > self.maxsize: self.data.popitem(last=False)
+
+    def pop(self, key): self.data.pop(key, None)
+
+    def clear(self): self.data.clear()
+
+MISS = object()
+uid_cache = TTLCache(5000, AVATAR_TTL)     # ник (lower) -> userId или None, если ника нет
+avatar_cache = TTLCache(1000, AVATAR_TTL)  # userId -> готовая аватарка 85x85 RGBA
+
+def _av_key(uid): return f"{DB_KEY}:av:{uid}"
+def _uid_key(username): return f"{DB_KEY}:uid:{username.lower()}"
+
+def _encode_avatar(img):
+    buf = io.BytesIO(); img.save(buf, format="PNG"); return buf.getvalue()
+
+# Декодирование, resize и запись PNG идут в пуле рендера: на холодном рендере их сотня, loop нужен /signal
+def _decode_avatar(raw): return Image.open(io.BytesIO(raw)).convert("RGBA").resize(AVATAR_SIZE, Image.LANCZOS)
+
+def _decode_stored_avatars(raws):
+    return {uid: Image.open(io.BytesIO(base64.b64decode(raw))).convert("RGBA") for uid, raw in raws.items() if raw}
+
+def _read_disk_avatars(uids):
+    found = {}
+    for uid in uids:
+        path = os.path.join(AVATAR_DIR, f"{uid}.png")
+        try:
+            if time.time() - os.path.getmtime(path) < AVATAR_TTL: found[uid] = Image.open(path).convert("RGBA")
+        except FileNotFoundError: pass
+    return found
+
+def _encode_stored_avatars(images): return {uid: base64.b64encode(_encode_avatar(img)).decode() for uid, img in images.items()}
+
+def _write_disk_avatars(images):
+    os.makedirs(AVATAR_DIR, exist_ok=True)
+    for uid, img in images.items(): img.save(os.path.join(AVATAR_DIR, f"{uid}.png"), format="PNG")
+
+async def resolve_user_ids(usernames, session):
+    """Ник -> userId пачками по 100 через users/v1/usernames/users, с кэшем в памяти и Redis."""
+    res, missing = {}, []
+    for u in usernames:
+        uid = uid_cache.get(u.lower(), MISS)
+        if uid is MISS: missing.append(u)
+        else: res[u] = uid
+    if missing and db:
+        try:
+            still = []
+            for u, v in zip(missing, await db.mget([_uid_key(u) for u in missing])):
+                if v is None: still.append(u); continue
+                res[u] = int(v) or None; uid_cache.set(u.lower(), res[u])
+            missing = still
+        except Exception: swallowed("uid_cache_redis")
+    for i in range(0, len(missing), 100):
+        chunk = missing[i:i+100]
+        try:
+            async with session.post(ROBLOX_USERS_URL, json={"usernames": chunk, "excludeBannedUsers": False}) as r:
+                found = {x["requestedUsername"].lower(): x["id"] for x in (await r.json())["data"]}
+        except Exception: swallowed("roblox_users"); continue
+        pipe = db.pipeline() if db else None
+        for u in chunk:
+            uid = found.get(u.lower())
+            # Несуществующий ник кэшируем ненадолго: вдруг его ещё переименуют обратно
+            ttl = AVATAR_TTL if uid else 600
+            res[u] = uid; uid_cache.set(u.lower(), uid, ttl)
+            if pipe is not None: pipe.setex(_uid_key(u), ttl, uid or 0)
+        if pipe is not None:
+            try: await pipe.execute()
+            except Exception: swallowed("uid_cache_store")
+    return res
+
+async def _load_stored_avatars(uids):
+    """Достаёт уже уменьшенные аватарки из Redis (или с диска, если Redis нет)."""
+    loop = asyncio.get_running_loop()
+    if db:
+        try:
+            raws = dict(zip(uids, await db.mget([_av_key(uid) for uid in uids])))
+            return await loop.run_in_executor(render_pool, _decode_stored_avatars, raws)
+        except Exception: swallowed("avatar_load_redis"); return {}
+    try: return await loop.run_in_executor(render_pool, _read_disk_avatars, uids)
+    except Exception: swallowed("avatar_load_disk"); return {}
+
+async def _store_avatars(images):
+    loop = asyncio.get_running_loop()
+    if db:
+        try:
+            pipe = db.pipeline()
+            for uid, b64 in (await loop.run_in_executor(render_pool, _encode_stored_avatars, images)).items(): pipe.setex(_av_key(uid), AVATAR_TTL, b64)
+            await pipe.execute()
+        except Exception: swallowed("avatar_store_redis")
+        return
+    try: await loop.run_in_executor(render_pool, _write_disk_avatars, images)
+    except Exception: swallowed("avatar_store_disk")
+
+async def _download_avatar(url, session, sem):
+    async with sem:
+        try:
+            async with session.get(url) as r: raw = await r.read()
+            return await asyncio.get_running_loop().run_in_executor(render_pool, _decode_avatar, raw)
+        except Exception: swallowed("avatar_download"); return None
+
+async def get_avatars(usernames, session):
+    """Ник -> аватарка 85x85. Повторные вызовы почти не ходят в сеть."""
+    ids = await resolve_user_ids(usernames, session)
+    uids = {uid for uid in ids.values() if uid}
+    need = [uid for uid in uids if avatar_cache.get(uid) is None]
+    M_CACHE.inc(len(uids) - len(need), cache="avatar", result="hit"); M_CACHE.inc(len(need), cache="avatar", result="miss")
+    if need:
+        for uid, img in (await _load_stored_avatars(need)).items(): avatar_cache.set(uid, img)
+        need = [uid for uid in need if avatar_cache.get(uid) is None]
+    for i in range(0, len(need), 100):
+        chunk = need[i:i+100]
+        try:
+            params = {"userIds": ",".join(map(str, chunk)), "size": "150x150", "format": "Png", "isCircular": "true"}
+            async with session.get(ROBLOX_THUMBS_URL, params=params) as r:
+                urls = {x["targetId"]: x["imageUrl"] for x in (await r.json())["data"] if x.get("state") == "Completed" and x.get("imageUrl")}
+        except Exception: swallowed("roblox_thumbnails"); continue
+        sem = asyncio.Semaphore(AVATAR_CONCURRENCY)
+        got = await asyncio.gather(*(_download_avatar(url, session, sem) for url in urls.values()))
+        fresh = {uid: img for uid, img in zip(urls.keys(), got) if img is not None}
+        for uid, img in fresh.items(): avatar_cache.set(uid, img)
+        await _store_avatars(fresh)
+    return {u: avatar_cache.get(uid) for u, uid in ids.items() if uid and avatar_cache.get(uid) is not None}
 
 # --- База Данных ---
+# Раскладка в Redis: хэш на каждую карту, список для логов и хэш meta для скаляров.
+# Ключи хэшей совпадают с полями старого JSON-блоба под DB_KEY, поэтому миграция сводится к переносу.
+HASH_DOMAINS = {
+    "notifs": notifications, "msgs": status_messages, "accounts": accounts, "starts": start_times,
+    "pause_data": pause_data, "init_h": initial_honey, "dc_counts": disconnect_counts, "stats": acc_stats,
+    "fleets": fleets
+}
+META_GLOBALS = {"total_restarts": "total_restarts", "session_restarts": "session_restarts", "check_timeout": "check_timeout",
+                "custom_bgs": "custom_backgrounds", "active_bg": "active_bg"}  # поле meta -> имя глобала
+SAVE_DELAY = float(os.getenv("SAVE_DELAY", 2))
+dirty = {}          # домен -> множество изменённых полей (None = переписать домен целиком)
+pending_logs = []   # новые события журнала, ещё не попавшие в Redis
+pending_rollups = []  # закрытые минутные/часовые бакеты истории: (ник, уровень, ts, мёд, сумка)
+save_event = asyncio.Event()
+
+def _db_key(domain): return f"{DB_KEY}:{domain}"
+
+def mark_dirty(domain, *fields):
+    """Помечает поля домена изменёнными; запись сделает save_loop одним пайплайном."""
+    cur = dirty.get(domain, set())
+    dirty[domain] = None if cur is None or not fields else cur | set(fields)
+    if domain in FLEET_DOMAINS: touch_fleets(*fields)
+    save_event.set()
+
+def _meta(): return {k: globals()[g] for k, g in META_GLOBALS.items()}
+
+async def _read_layout():
+    pipe = db.pipeline()
+    for d in HASH_DOMAINS: pipe.hgetall(_db_key(d))
+    pipe.hgetall(_db_key("meta")); pipe.lrange(_db_key("logs"), 0, -1); pipe.exists(_db_key("eventlog"))
+    *maps, meta, logs, has_stream = await pipe.execute()
+    data = {d: {k: json.loads(v) for k, v in m.items()} for d, m in zip(HASH_DOMAINS, maps)}
+    data.update({k: json.loads(v) for k, v in meta.items()}); data["logs"] = [] if has_stream else logs
+    return data
+
 async def load_data():
-    global db, notifications, status_messages, total_restarts, session_restarts, start_times, accounts, pause_data, action_logs, initial_honey
-    global disconnect_counts, check_timeout, custom_backgrounds, active_bg
-    if not REDIS_URL: return
+    """Поднимает состояние из Redis; False — Redis недоступен и работаем с пустым состоянием."""
+    global db, total_restarts, session_restarts, check_timeout, custom_backgrounds, active_bg
+    if not REDIS_URL: return True
     try:
         db = redis.from_url(REDIS_URL, decode_responses=True)
-        raw = await db.get(DB_KEY)
-        if raw:
-            data = json.loads(raw)
+        legacy = await db.type(DB_KEY) == "string"
+        data = json.loads(await db.get(DB_KEY)) if legacy else await _read_layout()
+        if data:
             notifications.update(data.get("notifs", {}))
             status_messages.update(data.get("msgs", {}))
+            fleets.update(data.get("fleets", {}))
             total_restarts = data.get("total_restarts", 0) + 1
             session_restarts = data.get("session_restarts", 0) + 1
-            pause_data = data.get("pause_data", {})
-            action_logs = data.get("logs", [])
-            initial_honey = data.get("init_h", {})
-            disconnect_counts = data.get("dc_counts", {})
+            pause_data.update(data.get("pause_data", {}))
+            # Старый список из 10 строк переезжает в стрим журнала, сам список удалит save_data
+            for line in reversed(data.get("logs", [])): pending_logs.append({"ts": f"{time.time():.0f}", "text": line, "kind": "system", "acc": ""})
+            if data.get("logs"): mark_dirty("logs")
+            initial_honey.update(data.get("init_h", {}))
+            disconnect_counts.update(data.get("dc_counts", {}))
             check_timeout = data.get("check_timeout", 120)
             custom_backgrounds = data.get("custom_bgs", [])
             active_bg = data.get("active_bg", None)
             saved_accs = data.get("accounts", {})
             now = time.time()
+            # Приём heartbeat'ов стартует раньше загрузки: свежие данные из памяти не затираем
             for u, p in saved_accs.items():
                 if now - float(p) < check_timeout:
-                    accounts[u] = float(p)
+                    accounts[u] = max(float(p), accounts.get(u, 0))
                     if u in data.get("starts", {}): start_times[u] = float(data["starts"][u])
-    except: pass
+                    if u in data.get("stats", {}): acc_stats.setdefault(u, data["stats"][u])
+            rebuild_fleets(); rebuild_aggregates()
+        if SHARED_STATE and not legacy:
+            # Соседние реплики пишут в те же хэши: удаляем только своё протухшее, остальное не трогаем
+            stale = [u for u in data.get("accounts", {}) if u not in accounts]
+            for d in ("accounts", "starts", "stats"):
+                if stale: mark_dirty(d, *stale)
+            mark_dirty("meta")
+        else:
+            # После старта переписываем всё один раз: отброшенные старые аккаунты и счётчик рестартов
+            for d in list(HASH_DOMAINS) + ["meta", "logs"]: mark_dirty(d)
+        if legacy:
+            await save_data(); await db.rename(DB_KEY, f"{DB_KEY}:legacy_blob")
+            logger.info("Старый JSON-блоб перенесён в раскладку по хэшам")
+        return True
+    except Exception: swallowed("load_data"); logger.error("Не удалось загрузить состояние из Redis"); return False
 
 async def save_data():
+    """Сбрасывает в Redis только изменённые поля одним пайплайном."""
+    global dirty, pending_logs, pending_rollups, pending_daily
+    if not db or not dirty: return
+    batch, logs, rollups, dirty, pending_logs, pending_rollups = dirty, pending_logs, pending_rollups, {}, [], []
+    daily, pending_daily = pending_daily, {}
+    pipe, changes = db.pipeline(), {}
+    for domain, fields in batch.items():
+        key = _db_key(domain)
+        if domain == "ts":
+            for u, level, t, h, b in rollups:
+                rkey = _ts_key(level, u); pipe.zremrangebyscore(rkey, t, t)
+                pipe.zadd(rkey, {f"{t:.0f},{h:.0f},{b:.0f}": t}); pipe.zremrangebyrank(rkey, 0, -TS_CAPS[level] - 1)
+        elif domain == "daily":
+            for (day, kind, u), n in daily.items():
+                zkey = _db_key(f"daily:{day}:{kind}")
+                pipe.zincrby(zkey, n, u); pipe.expire(zkey, DAILY_KEEP); pipe.hincrbyfloat(_db_key("daily_totals"), f"{day}:{kind}", n)
+        elif domain == "meta": changes[domain] = _meta(); pipe.hset(key, mapping={k: json.dumps(v) for k, v in _meta().items()})
+        elif domain == "logs":
+            if fields is None: pipe.delete(key)  # список логов старой раскладки
+            for ev in logs:
+                pipe.xadd(_db_key("eventlog"), ev, maxlen=LOG_CAP, approximate=True)
+                for k in _log_keys(ev): pipe.xadd(_db_key(f"eventlog:{k}"), ev, maxlen=LOG_INDEX_CAP, approximate=True)
+        else:
+            src = HASH_DOMAINS[domain]
+            if fields is None:
+                pipe.delete(key); changes[domain] = {"*": dict(src)}
+                if src: pipe.hset(key, mapping={k: json.dumps(v) for k, v in src.items()})
+                continue
+            changes[domain] = {f: src.get(f) for f in fields}
+            for f in fields:
+                if f in src: pipe.hset(key, f, json.dumps(src[f]))
+                else: pipe.hdel(key, f)
+    if SHARED_STATE and changes: pipe.publish(_db_key("events"), json.dumps({"from": REPLICA_ID, "changes": changes}))
+    M_SAVE_BYTES.set(sum(len(str(a)) for cmd in pipe.command_stack for a in cmd[0]))
+    try:
+        with M_SAVE_SECONDS.time(): await pipe.execute()
+    except Exception:
+        swallowed("save_data")
+        # Не теряем изменения: вернём их в очередь на следующую попытку
+        for domain, fields in batch.items():
+            if fields is None: mark_dirty(domain)
+            else: mark_dirty(domain, *fields)
+        pending_logs[:0] = logs; pending_rollups[:0] = rollups
+        for k, n in daily.items(): pending_daily[k] = pending_daily.get(k, 0) + n
+
+async def save_loop():
+    while True:
+        await save_event.wait(); await asyncio.sleep(SAVE_DELAY)
+        save_event.clear(); await save_data()
+
+# --- Несколько реплик ---
+# SHARED_STATE=1: реплики за балансировщиком делят состояние через Redis. Каждый сброс save_data
+# публикует изменённые поля в DB_KEY:events, соседи применяют их к своим словарям. Монитор вылетов,
+# обновление панелей и polling крутит только лидер — держатель lease-ключа DB_KEY:leader.
+SHARED_STATE = os.getenv("SHARED_STATE") == "1"
+if SHARED_STATE and not REDIS_URL:
+    # Без Redis некому выдать lease: реплика навсегда осталась бы не-лидером без алертов и панелей
+    logger.warning("SHARED_STATE=1 без REDIS_URL — общий режим выключен, работаем одной репликой"); SHARED_STATE = False
+REPLICA_ID = f"{os.getenv('HOSTNAME', 'bss')}-{os.getpid()}"
+LEASE_TTL = 15
+is_leader = not SHARED_STATE
+leader_changed = asyncio.Event()
+RENEW_LEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+
+def apply_changes(changes):
+    """Применяет изменения, опубликованные другой репликой."""
+    for domain, fields in changes.items():
+        if domain == "meta":
+            old = check_timeout
+            for k, v in fields.items():
+                if k in META_GLOBALS: globals()[META_GLOBALS[k]] = v
+            if check_timeout != old: reschedule_all()
+        elif domain in HASH_DOMAINS:
+            src = HASH_DOMAINS[domain]
+            if "*" in fields: src.clear(); src.update(fields["*"]); continue
+            for f, v in fields.items():
+                if v is None: src.pop(f, None)
+                else: src[f] = v
+    for u in changes.get("accounts", {}):
+        if u in accounts: schedule("acc", u, accounts[u] + check_timeout)
+    for u in changes.get("pause_data", {}):
+        if u in pause_data: schedule("pause", u, pause_data[u].get("until", 0))
+    for u in changes.get("starts", {}):
+        if u in start_times: note_recovery(u)  # вход на соседней реплике закрывает сводку лидера
+    if "*" in changes.get("stats", {}) or "*" in changes.get("dc_counts", {}): rebuild_aggregates()
+    else:
+        for u in changes.get("stats", {}): track_profit(u)
+        for u in changes.get("dc_counts", {}): track_disconnects(u)
+    if "fleets" in changes or "msgs" in changes: rebuild_fleets()
+    for domain, fields in changes.items():
+        if domain in FLEET_DOMAINS:
+            if domain == "meta" or "*" in fields: touch_fleets()
+            else: touch_fleets(*fields)
+    request_refresh()
+
+async def replica_listener():
+    while True:
+        try:
+            ps = db.pubsub(); await ps.subscribe(_db_key("events"))
+            async for msg in ps.listen():
+                if msg["type"] != "message": continue
+                ev = json.loads(msg["data"])
+                if ev.get("from") != REPLICA_ID: apply_changes(ev["changes"])
+        except Exception: swallowed("replica_listener"); await asyncio.sleep(1)
+
+async def leader_loop():
+    """Берёт и продлевает lease; при потере Redis лидер снимает с себя роль, а не шлёт алерты вслепую."""
+    global is_leader
+    key = _db_key("leader")
+    while True:
+        try:
+            if is_leader: ok = await db.eval(RENEW_LEASE, 1, key, REPLICA_ID, LEASE_TTL * 1000)
+            else: ok = await db.set(key, REPLICA_ID, nx=True, px=LEASE_TTL * 1000)
+        except Exception: swallowed("leader_lease"); ok = False
+        if bool(ok) != is_leader:
+            is_leader = bool(ok); leader_changed.set()
+            logger.info("Реплика %s %s лидером", REPLICA_ID, "стала" if is_leader else "перестала быть")
+            if is_leader: reschedule_all(); request_refresh()
+        await asyncio.sleep(LEASE_TTL / 3)
+
+async def claim_alert(u):
+    """Алерт о вылете сессии шлётся один раз, даже если лидер сменился посреди обработки."""
+    if not SHARED_STATE or not db: return True
+    try: return bool(await db.set(_db_key(f"alerted:{u}:{start_times.get(u, 0):.0f}"), REPLICA_ID, nx=True, ex=24 * 3600))
+    except Exception: swallowed("claim_alert"); return False
+
+async def poll_while_leader():
+    """Telegram отдаёт getUpdates только одному клиенту, поэтому опрашивает его лидер."""
+    polling = None
+    while True:
+        if is_leader and polling is None: polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+        elif not is_leader and polling is not None:
+            try: await dp.stop_polling()
+            except RuntimeError: pass
+            polling = None
+        await leader_changed.wait(); leader_changed.clear()
+
+# --- История мёда ---
+# Сырые heartbeat'ы лежат в кольцах на array (без объекта на точку) и сворачиваются в минутные
+# и часовые бакеты: ts начала, последний мёд, максимум сумки. Закрытые бакеты уходят в Redis ZSET'ами
+# со ts в качестве score: реплики закрывают один и тот же бакет каждая по-своему, и повторная запись
+# заменяет прежнюю, а не добавляет строку вне порядка времени.
+TS_CAPS = {"raw": 360, "m": 24 * 60, "h": 24 * 14}
+TS_STEP = {"m": 60, "h": 3600}
+series = {}  # ник -> Series
+
+def _ts_key(level, u): return f"{DB_KEY}:tsz:{level}:{u}"
+def _legacy_ts_key(level, u): return f"{DB_KEY}:ts:{level}:{u}"  # списки до перехода на ZSET, только чтение
+
+class Ring:
+    """Кольцевой буфер точек (время, мёд, сумка) фиксированной ёмкости."""
+    def __init__(self, cap):
+        self.cap, self.n, self.start = cap, 0, 0
+        self.ts, self.honey, self.bag = array('d', bytes(8 * cap)), array('d', bytes(8 * cap)), array('f', bytes(4 * cap))
+
+    def push(self, t, h, b):
+        i = (self.start + self.n) % self.cap
+        if self.n == self.cap: self.start = (self.start + 1) % self.cap
+        else: self.n += 1
+        self.ts[i], self.honey[i], self.bag[i] = t, h, b
+
+    def _at(self, k): return (self.start + k) % self.cap
+
+    def first_after(self, t):
+        """Логический индекс первой точки с ts >= t (бинарный поиск по кольцу)."""
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.ts[self._at(mid)] < t: lo = mid + 1
+            else: hi = mid
+        return lo
+
+    def points(self, since=0):
+        for k in range(self.first_after(since), self.n):
+            i = self._at(k); yield self.ts[i], self.honey[i], self.bag[i]
+
+class Series:
+    """История одного аккаунта: сырые точки и открытые минутный/часовой бакеты."""
+    def __init__(self, u):
+        self.u, self.rings = u, {level: Ring(cap) for level, cap in TS_CAPS.items()}
+        self.open = {}  # уровень -> [начало бакета, последний мёд, максимум сумки]
+
+    def add(self, t, h, b):
+        self.rings["raw"].push(t, h, b)
+        for level, step in TS_STEP.items():
+            start, cur = t - t % step, self.open.get(level)
+            if cur and cur[0] == start: cur[1] = h; cur[2] = max(cur[2], b); continue
+            if cur: self._close(level, *cur)
+            self.open[level] = [start, h, b]
+
+    def _close(self, level, t, h, b):
+        self.rings[level].push(t, h, b)
+        if REDIS_URL: pending_rollups.append((self.u, level, t, h, b)); mark_dirty("ts", "new")
+
+    def points(self, level, since=0):
+        yield from self.rings[level].points(since)
+        cur = self.open.get(level)
+        if cur and cur[0] >= since: yield tuple(cur)
+
+    def rate(self, now, window=3600):
+        """Мёд в час по минутным бакетам за последний window; None, пока истории меньше 5 минут."""
+        ring, cur = self.rings["m"], self.open.get("m")
+        if not cur: return None
+        k = ring.first_after(now - window)
+        if k >= ring.n: return None
+        i = ring._at(k); dt = cur[0] - ring.ts[i]
+        return (cur[1] - ring.honey[i]) * 3600 / dt if dt >= 300 else None
+
+async def _load_series(s):
+    """Подтягивает сохранённые бакеты из Redis под уже накопленные в памяти точки."""
     if not db: return
     try:
-        await db.set(DB_KEY, json.dumps({
-            "notifs": notifications, "msgs": status_messages, "total_restarts": total_restarts,
-            "session_restarts": session_restarts, "starts": start_times, "accounts": accounts,
-            "pause_data": pause_data, "logs": action_logs, "init_h": initial_honey,
-            "dc_counts": disconnect_counts, "check_timeout": check_timeout,
-            "custom_bgs": custom_backgrounds, "active_bg": active_bg
-        }))
-    except: pass
+        pipe = db.pipeline()
+        for level in TS_STEP: pipe.lrange(_legacy_ts_key(level, s.u), 0, -1); pipe.zrange(_ts_key(level, s.u), 0, -1)
+        res = await pipe.execute()
+        for k, level in enumerate(TS_STEP):
+            ring, fresh = s.rings[level], Ring(TS_CAPS[level])
+            first = ring.ts[ring._at(0)] if ring.n else float("inf")
+            rows = {}  # ts бакета -> строка; ZSET перекрывает старый список
+            for row in res[2 * k] + res[2 * k + 1]: rows[float(row.split(",", 1)[0])] = row
+            for t in sorted(rows)[-TS_CAPS[level]:]:
+                _, h, b = map(float, rows[t].split(","))
+                if t < first: fresh.push(t, h, b)
+            for p in ring.points(): fresh.push(*p)
+            s.rings[level] = fresh
+    except Exception: swallowed("load_series")
+
+def record_sample(u, t, honey, bag):
+    s = series.get(u)
+    if s is None: s = series[u] = Series(u); spawn(_load_series(s))
+    s.add(t, honey, bag)
+
+# --- Итоги и рейтинги ---
+# Итоги сессии ведутся на лету: heartbeat и вылет правят общую сумму и ленивые top-K кучи, так что
+# «Итоги сессии» и /top не перебирают все аккаунты. Дневные приросты копятся в pending_daily и
+# уходят в Redis: ZINCRBY в DB_KEY:daily:<день>:prof|dc и суммы в хэше DB_KEY:daily_totals.
+TOP_K = 10
+DAILY_KEEP = 35 * 86400
+pending_daily = {}  # (день, "prof"|"dc", ник) -> прирост, ещё не попавший в Redis
+
+class TopK:
+    """Ленивая max-куча: обновление — push новой записи, устаревшие выкидываются при чтении."""
+    def __init__(self): self.scores, self.heap = {}, []
+
+    def set(self, u, v):
+        if v is None: self.scores.pop(u, None); return
+        if self.scores.get(u) == v: return
+        self.scores[u] = v; heapq.heappush(self.heap, (-v, u))
+        if len(self.heap) > 2 * len(self.scores) + 64:
+            self.heap = [(-v, u) for u, v in self.scores.items()]; heapq.heapify(self.heap)
+
+    def clear(self): self.scores.clear(); self.heap.clear()
+
+    def top(self, k):
+        out = []
+        while self.heap and len(out) < k:
+            neg, u = heapq.heappop(self.heap)
+            if self.scores.get(u) == -neg and all(u != o for o, _ in out): out.append((u, -neg))
+        for u, v in out: heapq.heappush(self.heap, (-v, u))
+        return out
+
+top_profit, top_dc = TopK(), TopK()
+session_profit = 0.0
+
+def _day(days_ago=0):
+    return (datetime.datetime.now(timezone(timedelta(hours=2))) - timedelta(days=days_ago)).strftime("%Y-%m-%d")
+
+def _add_daily(kind, u, n):
+    if not REDIS_URL: return
+    key = (_day(), kind, u); pending_daily[key] = pending_daily.get(key, 0) + n; mark_dirty("daily", "new")
+
+def track_profit(u):
+    """Сверяет итоги сессии с acc_stats[u]. Дневной итог сюда не смотрит: raw_prof перебазируется при
+    сбросе сессии и загрузке, поэтому apply_signal пишет в него разницу сырого мёда с acc_stats[u]["raw_h"]."""
+    global session_profit
+    new, old = acc_stats[u].get("raw_prof", 0) if u in acc_stats else None, top_profit.scores.get(u)
+    session_profit += (new or 0) - (old or 0); top_profit.set(u, new)
+
+def track_disconnects(u): top_dc.set(u, disconnect_counts.get(u))
+
+def rebuild_aggregates():
+    """Полный пересчёт — после загрузки, сброса сессии и полной замены домена соседней репликой."""
+    global session_profit
+    top_profit.clear(); top_dc.clear(); session_profit = 0.0
+    for u in acc_stats: track_profit(u)
+    for u in disconnect_counts: track_disconnects(u)
+
+async def leaderboard(period):
+    """Общий мёд, топ по мёду и топ по вылетам за сессию (из памяти) или за день/неделю (из Redis)."""
+    if period == "session": return session_profit, top_profit.top(TOP_K), top_dc.top(5)
+    days = [_day(i) for i in range(1 if period == "day" else 7)]
+    keys = {kind: [_db_key(f"daily:{d}:{kind}") for d in days] for kind in ("prof", "dc")}
+    pipe = db.pipeline()
+    for kind, src in keys.items():
+        if len(src) > 1:  # неделя: складываем дни во временный ключ
+            tmp = _db_key(f"weekly:{kind}:{days[0]}"); pipe.zunionstore(tmp, src); pipe.expire(tmp, 600); src[:] = [tmp]
+    pipe.zrevrange(keys["prof"][0], 0, TOP_K - 1, withscores=True); pipe.zrevrange(keys["dc"][0], 0, 4, withscores=True)
+    pipe.hmget(_db_key("daily_totals"), [f"{d}:prof" for d in days])
+    *_, prof, dc, totals = await pipe.execute()
+    return sum(float(t or 0) for t in totals), prof, [(u, int(n)) for u, n in dc]
 
 # --- Отрисовка ---
-async def generate_status_image(target_accounts, is_online_mode=True):
-    width, row_h, head_h, foot_h = 750, 115, 130, 80
-    height = head_h + (max(1, len(target_accounts)) * row_h) + foot_h
-    img = Image.new("RGBA", (width, height), (40, 40, 40, 255))
-    try:
-        if active_bg:
-            file = await bot.get_file(active_bg)
-            bg_bytes = io.BytesIO()
-            await bot.download_file(file.file_path, destination=bg_bytes)
-            bg = Image.open(bg_bytes).convert("RGBA")
-        else:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(random.choice(BG_URLS)) as r:
-                    bg = Image.open(io.BytesIO(await r.read())).convert("RGBA")
-        bg = bg.resize((width, height), Image.LANCZOS)
-        img.paste(bg, (0, 0))
-    except Exception as e: pass
+render_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+render_slots = asyncio.Semaphore(RENDER_WORKERS + RENDER_QUEUE)  # страницы уже принятых рендеров ждут очереди
+
+class RenderBusy(Exception):
+    """Все слоты рендера заняты: новый рендер не ставим в бесконечную очередь, а просим повторить позже."""
+inflight_renders = {}  # ключ снимка -> задача рендера страниц
+image_memo = TTLCache(256, 24 * 3600)  # ключ снимка -> file_id страниц, уже загруженных в Telegram
+
+def image_height(n): return HEAD_H + (max(1, n) * ROW_H) + FOOT_H
+
+bg_source_cache = TTLCache(2, 24 * 3600)  # id фона -> декодированный оригинал
+bg_cache = TTLCache(16, 24 * 3600)        # (id фона, ширина, высота) -> готовый RGBA холст
+
+def _decode_image(raw): return Image.open(io.BytesIO(raw)).convert("RGBA")
+
+async def _fetch_background(source):
+    if source in BG_URLS:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(source) as r: raw = await r.read()
+    else:
+        file = await bot.get_file(source)
+        bg_bytes = io.BytesIO()
+        await bot.download_file(file.file_path, destination=bg_bytes); raw = bg_bytes.getvalue()
+    return await asyncio.get_running_loop().run_in_executor(render_pool, _decode_image, raw)
+
+async def get_background(source, width, height):
+    """Копия фона нужного размера: сеть и LANCZOS только при первом обращении."""
+    key = (source, width, height)
+    bg = bg_cache.get(key)
+    M_CACHE.inc(cache="background", result="miss" if bg is None else "hit")
+    if bg is None:
+        src = bg_source_cache.get(source)
+        if src is None:
+            try: src = await _fetch_background(source)
+            except Exception: swallowed("background_fetch"); return None
+            bg_source_cache.set(source, src)
+        bg = await asyncio.get_running_loop().run_in_executor(render_pool, src.resize, (width, height), Image.LANCZOS)
+        bg_cache.set(key, bg)
+    return bg.copy()
+
+def evict_background(source):
+    bg_source_cache.pop(source)
+    for key in [k for k in bg_cache.data if k[0] == source]: bg_cache.pop(key)
+
+async def warm_background(source):
+    """Прогревает кэш под текущее число аккаунтов, чтобы первый /img не ждал загрузки."""
+    pages, cols, per_col = paginate(range(len(set(accounts) | set(pause_data))))
+    for size in {page_size(len(rows), cols, per_col) for rows in pages if rows}: await get_background(source, *size)  # полная и последняя страница
+
+def build_snapshot(target_accounts, is_online_mode=True):
+    """Снимок всего, что видно на картинке: обычные данные, которые можно отдать в поток."""
+    now, rows = time.time(), []
+    for acc in target_accounts:
+        st = acc_stats.get(acc, {"h": "0", "b": "0%", "raw_b": 0, "prof": "0"})
+        if acc in pause_data and now < pause_data[acc]['until']: status = ("pause", "ПАУЗА")
+        elif is_online_mode and acc in accounts:
+            dur = int(now - start_times.get(acc, now)); status = ("online", f"{dur//3600}ч {(dur%3600)//60}м")
+        else: status = ("wait", "WAITING")
+        rows.append((acc, f"Honey: {st['h']} (+{st['prof']})", min(100, st['raw_b']), st['b'], status))
+    return {"bg": active_bg or "random", "rows": rows}
+
+def snapshot_key(snap): return hashlib.sha1(json.dumps(snap, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+STATUS_STYLE = {"pause": (220, (255, 165, 0)), "online": (200, (100, 255, 100)), "wait": (210, (180, 180, 180))}
+TILE_X, TILE_W, TILE_H = 30, IMG_WIDTH - 60, ROW_H - 10
+tile_cache = TTLCache(int(os.getenv("TILE_CACHE_SIZE", 256)), 3600)  # хэш строки -> готовая плашка аккаунта
+
+def tile_key(row, uid): return hashlib.sha1(json.dumps([row, uid], ensure_ascii=False).encode()).hexdigest()
+
+def _draw_row_tile(row, av, f_m, f_s):
+    """Плашка одного аккаунта на прозрачном фоне; координаты относительно левого верхнего угла плашки."""
+    acc, honey, pct, bag, (kind, status) = row
+    tile = Image.new("RGBA", (TILE_W, TILE_H), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(tile)
+    draw.rounded_rectangle([0, 0, TILE_W-1, TILE_H-1], fill=(0, 0, 0, 180), radius=15)
+    if av: tile.paste(av, (15, 10), av)
+    draw.text((115, 12), acc, font=f_m, fill=(255, 255, 255))
+    draw.text((115, 50), honey, font=f_s, fill=(200, 200, 200))
+    draw.text((115, 75), " Bag:", font=f_s, fill=(200, 200, 200))
+    bar_x, bar_y, bar_w, bar_h = 190, 78, 150, 14
+    draw.rounded_rectangle([bar_x, bar_y, bar_x+bar_w, bar_y+bar_h], fill=(80, 80, 80, 255), radius=5)
+    if pct > 0:
+        fill_w = int((pct / 100) * bar_w)
+        color = (50, 205, 50) if pct < 60 else ((255, 165, 0) if pct < 85 else (255, 69, 0))
+        draw.rounded_rectangle([bar_x, bar_y, bar_x+fill_w, bar_y+bar_h], fill=color, radius=5)
+    draw.text((bar_x+bar_w+10, 75), bag, font=f_s, fill=(255, 255, 255))
+    dx, color = STATUS_STYLE[kind]
+    draw.text((IMG_WIDTH-dx-TILE_X, 35), status, font=f_m, fill=color)
+    return tile
+
+def page_layout(n):
+    """(колонок, строк в колонке): маленький флот — одна колонка как раньше, большой — сетка постранично."""
+    return (1, max(1, n)) if n <= GRID_MIN else (IMG_COLS, ROWS_PER_COL)
+
+def paginate(rows):
+    cols, per_col = page_layout(len(rows)); size = cols * per_col
+    return [rows[i:i+size] for i in range(0, max(1, len(rows)), size)], cols, per_col
+
+def encode_image(img):
+    """PNG, если укладывается в IMG_TARGET_BYTES; иначе JPEG/WebP, снижая качество до попадания в бюджет."""
+    buf = io.BytesIO()
+    if IMG_FORMAT in ("auto", "png"):
+        img.save(buf, format="PNG", compress_level=3)
+        if IMG_FORMAT == "png" or buf.tell() <= IMG_TARGET_BYTES: return buf.getvalue(), "png"
+    fmt = "WEBP" if IMG_FORMAT == "webp" else "JPEG"; rgb = img.convert("RGB")
+    for q in (IMG_QUALITY, 75, 60, 45):
+        buf = io.BytesIO(); rgb.save(buf, format=fmt, quality=q)
+        if buf.tell() <= IMG_TARGET_BYTES: break
+    return buf.getvalue(), fmt.lower().replace("jpeg", "jpg")
+
+def _draw_status_page(rows, keys, cols, per_col, title, img, avatars, tiles):
+    """Склейка страницы из плашек и кодирование; выполняется в пуле потоков, без обращения к глобалам.
+    Недостающие плашки дорисовываются и возвращаются, чтобы кэш пополнялся уже в event loop."""
     draw = ImageDraw.Draw(img)
-    try: f_l = ImageFont.truetype(FONT_PATH, 42); f_m = ImageFont.truetype(FONT_PATH, 28); f_s = ImageFont.truetype(FONT_PATH, 18)
-    except: f_l = f_m = f_s = ImageFont.load_default()
-    draw.text((45, 40), "ОНЛАЙН МОНИТОРИНГ", font=f_l, fill=(255, 255, 255), stroke_width=2, stroke_fill=(0,0,0))
-    now = time.time()
-    async with aiohttp.ClientSession() as session:
-        for i, acc in enumerate(target_accounts):
-            y = head_h + (i * row_h)
-            draw.rounded_rectangle([30, y, width-30, y+row_h-10], fill=(0, 0, 0, 180), radius=15)
-            av = await get_avatar(acc, session)
-            if av: img.paste(av.resize((85, 85)), (45, y+10), av.resize((85, 85)))
-            
-            draw.text((145, y+12), acc, font=f_m, fill=(255, 255, 255))
-            st = acc_stats.get(acc, {"h": "0", "b": "0%", "raw_b": 0, "prof": "0"})
-            draw.text((145, y+50), f"Honey: {st['h']} (+{st['prof']})", font=f_s, fill=(200, 200, 200))
-            draw.text((145, y+75), " Bag:", font=f_s, fill=(200, 200, 200))
-            bar_x, bar_y, bar_w, bar_h = 220, y+78, 150, 14
-            draw.rounded_rectangle([bar_x, bar_y, bar_x+bar_w, bar_y+bar_h], fill=(80, 80, 80, 255), radius=5)
-            pct = min(100, st['raw_b'])
-            if pct > 0:
-                fill_w = int((pct / 100) * bar_w)
-                color = (50, 205, 50) if pct < 60 else ((255, 165, 0) if pct < 85 else (255, 69, 0))
-                draw.rounded_rectangle([bar_x, bar_y, bar_x+fill_w, bar_y+bar_h], fill=color, radius=5)
-            draw.text((bar_x+bar_w+10, y+75), st['b'], font=f_s, fill=(255, 255, 255))
-            if acc in pause_data and now < pause_data[acc]['until']:
-                draw.text((width-220, y+35), "ПАУЗА", font=f_m, fill=(255, 165, 0))
-            elif is_online_mode and acc in accounts:
-                dur = int(now - start_times.get(acc, now))
-                draw.text((width-200, y+35), f"{dur//3600}ч {(dur%3600)//60}м", font=f_m, fill=(100, 255, 100))
-            else:
-                draw.text((width-210, y+35), "WAITING", font=f_m, fill=(180, 180, 180))
+    fonts = get_fonts(); f_l, f_m, f_s = fonts[42], fonts[28], fonts[18]
+    draw.text((45, 40), title, font=f_l, fill=(255, 255, 255), stroke_width=2, stroke_fill=(0,0,0))
+    fresh = {}
+    for i, (row, key) in enumerate(zip(rows, keys)):
+        tile = tiles.get(key) or fresh.get(key)
+        if tile is None: tile = fresh[key] = _draw_row_tile(row, avatars.get(row[0]), f_m, f_s)
+        img.alpha_composite(tile, ((i // per_col) * IMG_WIDTH + TILE_X, HEAD_H + (i % per_col) * ROW_H))
+    return encode_image(img), fresh
+
+def page_size(n, cols, per_col):
+    """Размер страницы из n строк: по числу реально занятых колонок, а не по сетке целиком."""
+    return min(cols, -(-n // per_col)) * IMG_WIDTH, image_height(min(per_col, n))
+
+async def _render_page(rows, keys, cols, per_col, title, source, avatars, tiles):
+    width, height = page_size(len(rows), cols, per_col)
+    img = await get_background(source, width, height) or Image.new("RGBA", (width, height), (40, 40, 40, 255))
+    async with render_slots:
+        return await asyncio.get_running_loop().run_in_executor(render_pool, _draw_status_page, rows, keys, cols, per_col, title, img, avatars, tiles)
+
+async def _render_snapshot(snap):
+    source = random.choice(BG_URLS) if snap["bg"] == "random" else snap["bg"]
+    async with aiohttp.ClientSession() as session: avatars = await get_avatars([r[0] for r in snap["rows"]], session)
+    keys = [tile_key(row, uid_cache.get(row[0].lower()) if row[0] in avatars else None) for row in snap["rows"]]
+    tiles = {k: t for k in keys if (t := tile_cache.get(k)) is not None}
+    M_CACHE.inc(len(tiles), cache="tile", result="hit"); M_CACHE.inc(len(set(keys)) - len(tiles), cache="tile", result="miss")
+    pages, cols, per_col = paginate(snap["rows"]); size = cols * per_col
+    titles = [f"ОНЛАЙН МОНИТОРИНГ {i+1}/{len(pages)}" if len(pages) > 1 else "ОНЛАЙН МОНИТОРИНГ" for i in range(len(pages))]
+    with M_RENDER_SECONDS.time(kind="status"):
+        done = await asyncio.gather(*(_render_page(rows, keys[i*size:(i+1)*size], cols, per_col, titles[i], source, avatars, tiles)
+                                      for i, rows in enumerate(pages)))
+    for _, fresh in done:
+        for k, t in fresh.items(): tile_cache.set(k, t)
+    return [page for page, _ in done]
+
+async def generate_status_pages(target_accounts, is_online_mode=True):
+    """Страницы статуса [(байты, расширение)]. Одинаковые одновременные запросы ждут один и тот же рендер."""
+    snap = build_snapshot(target_accounts, is_online_mode); key = snapshot_key(snap)
+    task = inflight_renders.get(key)
+    if task is None:
+        if render_slots.locked(): raise RenderBusy()
+        task = inflight_renders[key] = asyncio.ensure_future(_render_snapshot(snap))
+        task.add_done_callback(lambda _: inflight_renders.pop(key, None))
+    return await asyncio.shield(task)
+
+CHART_W, CHART_H = 750, 420
+
+def _draw_chart(title, points):
+    """График мёда (линия) и сумки (столбики, красные при полной) по точкам истории."""
+    img = Image.new("RGBA", (CHART_W, CHART_H), (30, 30, 30, 255)); draw = ImageDraw.Draw(img)
+    fonts = get_fonts(); f_m, f_s = fonts[28], fonts[16]
+    left, right, h_top, h_bot, b_top, b_bot = 20, CHART_W - 20, 70, 270, 300, 390
+    t0, t1 = points[0][0], points[-1][0]
+    lo, hi = min(p[1] for p in points), max(p[1] for p in points)
+    x = lambda t: left + (t - t0) / ((t1 - t0) or 1) * (right - left)
+    draw.text((20, 15), title, font=f_m, fill=(255, 255, 255))
+    draw.rounded_rectangle([left, h_top, right, h_bot], outline=(70, 70, 70), radius=8)
+    draw.rounded_rectangle([left, b_top, right, b_bot], outline=(70, 70, 70), radius=8)
+    bar_w = max(1, int((right - left) / len(points)))
+    for t, _, b in points:
+        y = b_bot - min(100, b) / 100 * (b_bot - b_top)
+        draw.rectangle([x(t), y, x(t) + bar_w - 1, b_bot], fill=(255, 69, 0) if b >= 100 else (70, 130, 200))
+    line = [(x(t), h_bot - (h - lo) / ((hi - lo) or 1) * (h_bot - h_top)) for t, h, _ in points]
+    if len(line) > 1: draw.line(line, fill=(255, 200, 0), width=3)
+    draw.text((left + 8, h_top + 6), f"Honey max {format_honey(hi)}", font=f_s, fill=(255, 200, 0))
+    draw.text((left + 8, h_bot - 24), f"min {format_honey(lo)}", font=f_s, fill=(200, 200, 200))
+    draw.text((left + 8, b_top + 6), "Bag %", font=f_s, fill=(200, 200, 200))
+    tz = timezone(timedelta(hours=2)); fmt = lambda t: datetime.datetime.fromtimestamp(t, tz).strftime("%d.%m %H:%M")
+    draw.text((left, b_bot + 6), fmt(t0), font=f_s, fill=(160, 160, 160))
+    draw.text((right - 110, b_bot + 6), fmt(t1), font=f_s, fill=(160, 160, 160))
     buf = io.BytesIO(); img.save(buf, format='PNG'); return buf.getvalue()
 
-def get_status_text():
-    now_str = datetime.datetime.now(timezone(timedelta(hours=2))).strftime("%H:%M:%S")
+async def generate_chart(u, hours):
+    s = series.get(u)
+    if s is None:
+        s = Series(u); await _load_series(s)
+    level = "m" if hours <= 24 else "h"
+    points = list(s.points(level, since=time.time() - hours * 3600))
+    if len(points) < 2: return None
+    if render_slots.locked(): raise RenderBusy()
+    async with render_slots:
+        with M_RENDER_SECONDS.time(kind="chart"):
+            return await asyncio.get_running_loop().run_in_executor(render_pool, _draw_chart, f"{u} — {hours}ч", points)
+
+# --- Флоты ---
+# Флот — набор аккаунтов, за которыми следит чат (/follow). Чаты с одинаковым набором делят ключ флота,
+# ключ None — весь улей. Обратный индекс followers даёт по аккаунту ключи флотов, а fleet_chats — их чаты,
+# так что алерт и правка панели уходят только туда, где аккаунт видно.
+# Домены, которые видно в тексте панели. "accounts" сюда не входит: heartbeat лишь сдвигает время последнего
+# сигнала, а вход и вылет аккаунта и так проходят через "starts", новые цифры — через "stats".
+FLEET_DOMAINS = {"starts", "stats", "pause_data", "meta"}
+followers = {}     # аккаунт -> ключи флотов, где он есть
+fleet_chats = {}   # ключ флота -> чаты с панелью или подпиской
+fleet_versions = {}  # ключ флота -> версия; растёт при любом изменении его аккаунтов
+fleet_epoch = 0    # версия «всё поменялось»: mark_dirty без полей, сообщения соседних реплик
+fleet_clock = itertools.count(1)
+fleet_bodies = {}  # ключ флота -> (версия, минута, текст, хэш)
+
+def fleet_key(cid):
+    return tuple(sorted(fleets[cid])) if cid in fleets else None
+
+def rebuild_fleets():
+    """Пересобирает обратный индекс; вызывается только при смене подписок или панелей, не на heartbeat."""
+    global fleet_epoch
+    followers.clear(); fleet_chats.clear()
+    for cid in set(status_messages) | set(fleets):
+        key = fleet_key(cid); fleet_chats.setdefault(key, set()).add(cid)
+        for u in key or (): followers.setdefault(u, set()).add(key)
+    fleet_epoch = next(fleet_clock)
+
+def touch_fleets(*accs):
+    """Поднимает версию флотов, в которых есть эти аккаунты; без аргументов — всех."""
+    global fleet_epoch
+    if not accs: fleet_epoch = next(fleet_clock); return
+    ver = next(fleet_clock); fleet_versions[None] = ver
+    for u in accs:
+        for key in followers.get(u, ()): fleet_versions[key] = ver
+
+def chats_following(u):
+    """Чаты, которым нужен алерт по аккаунту: подписчики плюс панели без своего флота."""
+    chats = set(fleet_chats.get(None, ()))
+    for key in followers.get(u, ()): chats |= fleet_chats[key]
+    return list(chats)
+
+def fleet_body(key=None):
+    """Текст панели флота и его хэш; пересобирается, только когда сменилась версия флота или минута
+    (время в сети и остаток паузы показываются с точностью до минуты)."""
+    ver, minute = max(fleet_versions.get(key, 0), fleet_epoch), int(time.time() // 60)
+    hit = fleet_bodies.get(key)
+    if hit and hit[:2] == (ver, minute): return hit[2], hit[3]
+    body = get_status_body(key); h = hashlib.sha1(body.encode()).hexdigest()
+    fleet_bodies[key] = (ver, minute, body, h)
+    return body, h
+
+def get_status_body(fleet=None):
+    """Всё, кроме строки с часами: по этому тексту панели понимают, что поменялось."""
     now = time.time()
-    text = f"<b>🐝 Улей BSS {VERSION}</b>\n🕒 Время: <b>{now_str}</b>\n"
-    text += f"🔄 Рестартов: <b>{session_restarts}</b> (Всего: {total_restarts})\n\n"
-    acc_list = sorted(list(set(list(accounts.keys()) + list(pause_data.keys()))))
+    text = f"🔄 Рестартов: <b>{session_restarts}</b> (Всего: {total_restarts})\n\n"
+    if fleet is None: acc_list = sorted(list(set(list(accounts.keys()) + list(pause_data.keys()))))
+    else: acc_list = [u for u in fleet if u in accounts or u in pause_data]
     if not acc_list: text += "<blockquote>Ожидание сигналов...</blockquote>"
     else:
         for u in acc_list:
@@ -194,38 +1127,116 @@ def get_status_text():
                 d = int(now - start_times.get(u, now))
                 st = acc_stats.get(u, {"h": "0", "b": "0%", "prof": "0"})
                 text += f"🟢 <code>{u}</code> | 🍯 <b>{st['h']} (+{st['prof']})</b> | 🎒 <b>{st['b']}</b>\n"
-                text += f"└ 🕒 <b>{d//3600}ч {(d%3600)//60}м в сети</b>\n\n"
+                rate = series[u].rate(now) if u in series else None
+                rate = f" | 📈 <b>{format_honey(rate)}/ч</b>" if rate is not None else ""
+                text += f"└ 🕒 <b>{d//3600}ч {(d%3600)//60}м в сети</b>{rate}\n\n"
     return text
 
+def get_status_text(body=None):
+    now_str = datetime.datetime.now(timezone(timedelta(hours=2))).strftime("%H:%M:%S")
+    return f"<b>🐝 Улей BSS {VERSION}</b>\n🕒 Время: <b>{now_str}</b>\n" + (body if body is not None else fleet_body()[0])
+
 # --- Хендлеры Юзера ---
 @dp.message(Command("start"))
 async def cmd_start(m: types.Message):
-    await m.answer(f"<b>🐝 BSS {VERSION}</b>\n🔄 Общих рестартов бота: <b>{total_restarts}</b>\n\n/information — Статус\n/img — Картинка\n/logs — Логи событий\n/list — Пинги\n/add [Ник] [Тег]", parse_mode="HTML")
+    await m.answer(f"<b>🐝 BSS {VERSION}</b>\n🔄 Общих рестартов бота: <b>{total_restarts}</b>\n\n/information — Статус\n/img — Картинка\n/graph [Ник] — График мёда\n/top [день|неделя] — Рейтинг\n/logs [Ник] [тип] — Логи событий\n/list — Пинги\n/add [Ник] [Тег]\n/fleet — Флот чата\n/follow [Ник] — Следить\n/unfollow [Ник] — Не следить", parse_mode="HTML")
+
+async def query_logs(acc=None, kind=None, before=None, n=LOG_PAGE):
+    """Страница событий от новых к старым и курсор следующей. Читается индекс аккаунта, иначе индекс типа,
+    иначе общий журнал; тип при заданном аккаунте доотбирается внутри индекса аккаунта."""
+    key = f"acc:{acc}" if acc else f"kind:{kind}" if kind else None
+    match = lambda ev: (not acc or ev["acc"] == acc) and (not kind or ev["kind"] == kind)
+    page = []
+    if not db:
+        src = log_index.get(key, ()) if key else event_log
+        for ev in reversed(src):
+            if before is not None and ev["id"] >= int(before): continue
+            if match(ev): page.append(ev)
+            if len(page) > n: break
+    else:
+        # Ещё не сброшенные в Redis события — самые свежие, показываем их на первой странице
+        if before is None: page = [dict(ev, id="") for ev in reversed(pending_logs) if match(ev)]
+        stream, top = _db_key(f"eventlog:{key}" if key else "eventlog"), f"({before}" if before else "+"
+        while len(page) <= n:
+            chunk = await db.xrevrange(stream, max=top, min="-", count=n + 1)
+            page += [dict(ev, id=i) for i, ev in chunk if match(ev)]
+            if len(chunk) <= n: break
+            top = f"({chunk[-1][0]}"
+    more = len(page) > n; page = page[:n]
+    return page, (page[-1]["id"] if more and page[-1]["id"] != "" else None)
+
+def _logs_view(page, cursor, acc, kind):
+    title = "📋 События" + (f" <code>{acc}</code>" if acc else "") + (f" — {LOG_KINDS[kind]}" if kind else "")
+    text = f"<b>{title}:</b>\n\n" + ("\n".join(ev["text"] for ev in page) if page else "Событий нет.")
+    kb = [[InlineKeyboardButton(text="⬅️ Старше", callback_data=f"logs|{acc or ''}|{kind or ''}|{cursor}")]] if cursor else []
+    return text, InlineKeyboardMarkup(inline_keyboard=kb)
 
 @dp.message(Command("logs"))
 async def cmd_logs(m: types.Message):
-    if not action_logs: return await m.answer("Список логов пока пуст.")
-    await m.answer("<b>📋 Последние 10 событий:</b>\n\n" + "\n".join(action_logs), parse_mode="HTML")
+    """/logs [Ник] [login|disconnect|pause|admin|system] — последние события, с фильтрами и листанием."""
+    acc = kind = None
+    for a in m.text.split()[1:]:
+        if a.lower() in LOG_KINDS: kind = a.lower()
+        else: acc = a
+    page, cursor = await query_logs(acc, kind)
+    if not page and not acc and not kind: return await m.answer("Список логов пока пуст.")
+    text, kb = _logs_view(page, cursor, acc, kind)
+    await m.answer(text, parse_mode="HTML", reply_markup=kb)
+
+@dp.callback_query(F.data.startswith("logs|"))
+async def cb_logs_page(cb: types.CallbackQuery):
+    _, acc, kind, before = cb.data.split("|", 3)
+    page, cursor = await query_logs(acc or None, kind or None, before)
+    text, kb = _logs_view(page, cursor, acc or None, kind or None)
+    await cb.message.edit_text(text, parse_mode="HTML", reply_markup=kb); await cb.answer()
 
 @dp.message(Command("information"))
 async def cmd_info(m: types.Message):
     cid = str(m.chat.id)
     if cid in status_messages:
         try: await bot.delete_message(chat_id=cid, message_id=status_messages[cid])
-        except: pass
-    msg = await m.answer(get_status_text(), parse_mode="HTML", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⚙️ Настройки", callback_data="ask_reset")]]))
-    status_messages[cid] = msg.message_id
+        except Exception: swallowed("delete_panel")
+    msg = await m.answer(get_status_text(fleet_body(fleet_key(cid))[0]), parse_mode="HTML", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⚙️ Настройки", callback_data="ask_reset")]]))
+    status_messages[cid] = msg.message_id; panel_hashes.pop(cid, None); rebuild_fleets()
     try: await bot.pin_chat_message(chat_id=m.chat.id, message_id=msg.message_id, disable_notification=True)
-    except: pass
-    await save_data()
+    except Exception: swallowed("pin_panel")
+    mark_dirty("msgs", cid)
 
 @dp.message(Command("img"))
 async def cmd_img(m: types.Message):
     args = m.text.split()[1:]; is_on = len(args) == 0
     t_accs = list(set(list(accounts.keys()) + list(pause_data.keys()))) if is_on else args
     if not t_accs: return await m.answer("Список пуст.")
-    msg = await m.answer("🎨 Рисую..."); img_bytes = await generate_status_image(t_accs, is_online_mode=is_on)
-    await m.answer_photo(photo=BufferedInputFile(file=img_bytes, filename="bss.png")); await msg.delete()
+    key = snapshot_key(build_snapshot(t_accs, is_on)); file_ids = image_memo.get(key)
+    if file_ids:
+        try: return await send_pages(m, file_ids)
+        except Exception: swallowed("memo_send"); image_memo.pop(key)
+    msg = await m.answer("🎨 Рисую...")
+    try: pages = await generate_status_pages(t_accs, is_online_mode=is_on)
+    except RenderBusy: return await msg.edit_text("⏳ Сейчас рисуется слишком много картинок, попробуйте через минуту.")
+    files = [BufferedInputFile(file=data, filename=f"bss_{i+1}.{ext}") for i, (data, ext) in enumerate(pages)]
+    image_memo.set(key, await send_pages(m, files)); await msg.delete()
+
+async def send_pages(m, photos):
+    """Одна страница — обычным фото, несколько — альбомами по 10. Возвращает file_id отправленного."""
+    if len(photos) == 1: return [(await m.answer_photo(photo=photos[0])).photo[-1].file_id]
+    # sendMediaGroup принимает от 2 до 10 фото: режем на равные альбомы, чтобы не остался одиночный хвост
+    groups = -(-len(photos) // 10); size = -(-len(photos) // groups)
+    file_ids = []
+    for i in range(0, len(photos), size):
+        sent = await m.answer_media_group(media=[InputMediaPhoto(media=p) for p in photos[i:i+size]])
+        file_ids += [s.photo[-1].file_id for s in sent]
+    return file_ids
+
+@dp.message(Command("graph"))
+async def cmd_graph(m: types.Message):
+    args = m.text.split()[1:]
+    if not args: return await m.answer("Формат: /graph Ник [часы]")
+    hours = min(int(args[1]), 24 * 14) if len(args) > 1 and args[1].isdigit() and int(args[1]) > 0 else 6
+    try: png = await generate_chart(args[0], hours)
+    except RenderBusy: return await m.answer("⏳ Сейчас рисуется слишком много картинок, попробуйте через минуту.")
+    if not png: return await m.answer(f"Нет истории для <b>{args[0]}</b>.", parse_mode="HTML")
+    await m.answer_photo(photo=BufferedInputFile(file=png, filename="graph.png"))
 
 @dp.message(Command("list"))
 async def cmd_list(m: types.Message):
@@ -241,12 +1252,49 @@ async def cmd_add(m: types.Message):
     tag = args[2] if len(args) > 2 else (f"@{m.from_user.username}" if m.from_user.username else f"ID:{m.from_user.id}")
     if acc not in notifications: notifications[acc] = []
     if tag not in notifications[acc]: notifications[acc].append(tag)
-    await save_data(); await m.answer(f"✅ <b>{acc}</b> добавлен.", parse_mode="HTML")
+    mark_dirty("notifs", acc); await m.answer(f"✅ <b>{acc}</b> добавлен.", parse_mode="HTML")
 
 @dp.message(Command("remove"))
 async def cmd_remove(m: types.Message):
     args = m.text.split(); acc = args[1] if len(args) > 1 else None
-    if acc in notifications: del notifications[acc]; await save_data(); await m.answer(f"❌ {acc} удален.")
+    if acc in notifications: del notifications[acc]; mark_dirty("notifs", acc); await m.answer(f"❌ {acc} удален.")
+
+TOP_PERIODS = {"день": "day", "day": "day", "сегодня": "day", "неделя": "week", "week": "week"}
+TOP_TITLES = {"session": "сессия", "day": "сегодня", "week": "7 дней"}
+
+@dp.message(Command("top"))
+async def cmd_top(m: types.Message):
+    """/top [день|неделя] — рейтинг по мёду и вылетам; без аргумента — текущая сессия."""
+    args = m.text.split()[1:]; period = TOP_PERIODS.get(args[0].lower(), "session") if args else "session"
+    if period != "session" and not db: return await m.answer("История по дням доступна только с Redis.")
+    total, prof, dc = await leaderboard(period)
+    text = f"<b>🏆 Рейтинг — {TOP_TITLES[period]}</b>\n🍯 Общий фарм: <b>{format_honey(total)}</b>\n\n<b>Топ по мёду:</b>\n"
+    text += "\n".join(f"{i}. <code>{u}</code> — +{format_honey(v)}" for i, (u, v) in enumerate(prof, 1)) or "Нет данных"
+    text += "\n\n<b>💤 Больше всех вылетов:</b>\n" + ("\n".join(f"{i}. <code>{u}</code> — {n}" for i, (u, n) in enumerate(dc, 1)) or "Нет вылетов")
+    await m.answer(text, parse_mode="HTML")
+
+@dp.message(Command("fleet"))
+async def cmd_fleet(m: types.Message):
+    cid = str(m.chat.id)
+    if cid not in fleets: return await m.answer("🐝 Чат следит за всем ульем. /follow Ник — оставить только свои аккаунты.")
+    await m.answer("<b>🛸 Флот чата:</b>\n" + "\n".join(f"• <code>{u}</code>" for u in sorted(fleets[cid])), parse_mode="HTML")
+
+@dp.message(Command("follow"))
+async def cmd_follow(m: types.Message):
+    cid, accs = str(m.chat.id), m.text.split()[1:]
+    if not accs: return await m.answer("Формат: /follow Ник [Ник ...]")
+    fleets[cid] = sorted(set(fleets.get(cid, [])) | set(accs))
+    mark_dirty("fleets", cid); rebuild_fleets(); request_refresh()
+    await m.answer(f"✅ Во флоте: <b>{len(fleets[cid])}</b>.", parse_mode="HTML")
+
+@dp.message(Command("unfollow"))
+async def cmd_unfollow(m: types.Message):
+    cid, accs = str(m.chat.id), m.text.split()[1:]
+    if cid not in fleets or not accs: return await m.answer("Формат: /unfollow Ник [Ник ...]")
+    fleets[cid] = [u for u in fleets[cid] if u not in accs]
+    if not fleets[cid]: del fleets[cid]
+    mark_dirty("fleets", cid); rebuild_fleets(); request_refresh()
+    await m.answer(f"❌ Во флоте: <b>{len(fleets[cid])}</b>." if cid in fleets else "🐝 Флот пуст — чат снова следит за всем ульем.", parse_mode="HTML")
 
 # --- Админка Основная ---
 @dp.message(Command("adm"))
@@ -255,30 +1303,49 @@ async def cmd_adm(m: types.Message):
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📢 Рассылка", callback_data="adm_broadcast"), InlineKeyboardButton(text="🧪 Тест вылета", callback_data="adm_test_dc_menu")],
         [InlineKeyboardButton(text="📊 Итоги сессии", callback_data="adm_stats"), InlineKeyboardButton(text="🎚 Чувствительность", callback_data="adm_timeout")],
-        [InlineKeyboardButton(text="🖼 Управление фонами", callback_data="adm_bg_menu")]
+        [InlineKeyboardButton(text="🖼 Управление фонами", callback_data="adm_bg_menu"), InlineKeyboardButton(text="🩺 Профилирование", callback_data="adm_prof")]
     ])
     await m.answer("🕹 <b>Панель администратора:</b>", reply_markup=kb, parse_mode="HTML")
 
 # --- Новые функции админки ---
 @dp.callback_query(F.data == "adm_stats")
 async def cb_adm_stats(cb: types.CallbackQuery):
-    total_prof = sum(st.get("raw_prof", 0) for st in acc_stats.values())
-    top_farmer = max(acc_stats.keys(), key=lambda u: acc_stats[u].get("raw_prof", 0), default="Нет данных") if acc_stats else "Нет данных"
-    top_prof = format_honey(acc_stats[top_farmer].get("raw_prof", 0)) if top_farmer in acc_stats else "0"
-    sleepyhead = max(disconnect_counts.keys(), key=lambda u: disconnect_counts[u], default="Нет данных") if disconnect_counts else "Нет вылетов"
-    sl_cnt = disconnect_counts[sleepyhead] if sleepyhead in disconnect_counts else 0
+    (top_farmer, top_raw), = top_profit.top(1) or [("Нет данных", 0)]
+    (sleepyhead, sl_cnt), = top_dc.top(1) or [("Нет вылетов", 0)]
+    top_prof = format_honey(top_raw)
     text = f"<b>📊 Итоги текущей сессии:</b>\n\n"
-    text += f"🍯 <b>Общий фарм:</b> {format_honey(total_prof)}\n"
+    text += f"🍯 <b>Общий фарм:</b> {format_honey(session_profit)}\n"
     text += f"👑 <b>Топ фармер:</b> {top_farmer} (+{top_prof})\n"
     text += f"💤 <b>Соня дня:</b> {sleepyhead} ({sl_cnt} вылетов)\n"
     await cb.message.edit_text(text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data="adm_back")]]))
 
+@dp.callback_query(F.data == "adm_prof")
+async def cb_adm_prof(cb: types.CallbackQuery):
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⏱ CPU 10 сек", callback_data="prof_cpu_10"), InlineKeyboardButton(text="⏱ CPU 60 сек", callback_data="prof_cpu_60")],
+        [InlineKeyboardButton(text="🧠 Память 30 сек", callback_data="prof_mem_30"), InlineKeyboardButton(text="🐢 Медленные вызовы", callback_data="prof_slow")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="adm_back")]
+    ])
+    await cb.message.edit_text(f"🩺 <b>Профилирование</b>\n\nВ журнал попадают вызовы дольше {SLOW_CALL_MS:.0f} мс.\nЗамер присылается файлом.", parse_mode="HTML", reply_markup=kb)
+
+@dp.callback_query(F.data == "prof_slow")
+async def cb_prof_slow(cb: types.CallbackQuery):
+    if cb.from_user.username != ALLOWED_ADMIN: return await cb.answer()
+    await cb.message.answer("<b>🐢 Топ медленных мест:</b>\n\n" + (slow_report() or "Медленных вызовов не было."), parse_mode="HTML"); await cb.answer()
+
+@dp.callback_query(F.data.startswith("prof_"))
+async def cb_prof_run(cb: types.CallbackQuery):
+    if cb.from_user.username != ALLOWED_ADMIN: return await cb.answer()
+    if profiling.locked(): return await cb.answer("Замер уже идёт", show_alert=True)
+    _, mode, secs = cb.data.split("_"); await cb.answer(f"Замер {secs} сек...")
+    start_profile(cb.message.chat.id, mode, int(secs))
+
 @dp.callback_query(F.data == "adm_back")
 async def cb_adm_back(cb: types.CallbackQuery):
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📢 Рассылка", callback_data="adm_broadcast"), InlineKeyboardButton(text="🧪 Тест вылета", callback_data="adm_test_dc_menu")],
         [InlineKeyboardButton(text="📊 Итоги сессии", callback_data="adm_stats"), InlineKeyboardButton(text="🎚 Чувствительность", callback_data="adm_timeout")],
-        [InlineKeyboardButton(text="🖼 Управление фонами", callback_data="adm_bg_menu")]
+        [InlineKeyboardButton(text="🖼 Управление фонами", callback_data="adm_bg_menu"), InlineKeyboardButton(text="🩺 Профилирование", callback_data="adm_prof")]
     ])
     await cb.message.edit_text("🕹 <b>Панель администратора:</b>", reply_markup=kb, parse_mode="HTML")
 
@@ -287,7 +1354,7 @@ async def cb_adm_timeout(cb: types.CallbackQuery):
     global check_timeout
     if "plus" in cb.data: check_timeout += 30
     elif "minus" in cb.data and check_timeout > 30: check_timeout -= 30
-    await save_data()
+    mark_dirty("meta"); reschedule_all()
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="➖ 30 сек", callback_data="adm_timeout_minus"), InlineKeyboardButton(text="➕ 30 сек", callback_data="adm_timeout_plus")],
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="adm_back")]
@@ -307,7 +1374,7 @@ async def cb_bg_menu(cb: types.CallbackQuery):
 
 @dp.callback_query(F.data == "bg_reset")
 async def cb_bg_reset(cb: types.CallbackQuery):
-    global active_bg; active_bg = None; await save_data(); await cb.answer("Сброшено на стандарт!", show_alert=True); await cb_bg_menu(cb)
+    global active_bg; active_bg = None; mark_dirty("meta"); await cb.answer("Сброшено на стандарт!", show_alert=True); await cb_bg_menu(cb)
 
 @dp.callback_query(F.data == "bg_add")
 async def cb_bg_add(cb: types.CallbackQuery, state: FSMContext):
@@ -318,7 +1385,8 @@ async def cb_bg_add(cb: types.CallbackQuery, state: FSMContext):
 async def upload_bg(m: types.Message, state: FSMContext):
     global active_bg; file_id = m.photo[-1].file_id
     if file_id not in custom_backgrounds: custom_backgrounds.append(file_id)
-    active_bg = file_id; await save_data(); await state.clear()
+    active_bg = file_id; mark_dirty("meta"); await state.clear()
+    spawn(warm_background(file_id))
     await m.answer("✅ Фон успешно загружен и установлен как активный!")
 
 @dp.callback_query(F.data == "bg_list")
@@ -334,14 +1402,16 @@ async def cb_bg_list(cb: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("bg_set_"))
 async def cb_bg_set(cb: types.CallbackQuery):
     global active_bg; idx = int(cb.data.split("_")[2])
-    if idx < len(custom_backgrounds): active_bg = custom_backgrounds[idx]; await save_data(); await cb.answer(f"Фон #{idx+1} установлен!")
+    if idx < len(custom_backgrounds):
+        active_bg = custom_backgrounds[idx]; mark_dirty("meta"); await cb.answer(f"Фон #{idx+1} установлен!")
+        spawn(warm_background(active_bg))
 
 @dp.callback_query(F.data.startswith("bg_del_"))
 async def cb_bg_del(cb: types.CallbackQuery):
     global active_bg; idx = int(cb.data.split("_")[2])
     if idx < len(custom_backgrounds):
         if active_bg == custom_backgrounds[idx]: active_bg = None
-        custom_backgrounds.pop(idx); await save_data(); await cb.message.delete(); await cb.answer("Фон удален!")
+        evict_background(custom_backgrounds.pop(idx)); mark_dirty("meta"); await cb.message.delete(); await cb.answer("Фон удален!")
 
 # --- Старые админские команды (тест вылета, рассылка) ---
 @dp.callback_query(F.data == "adm_test_dc_menu")
@@ -353,8 +1423,8 @@ async def cb_test_dc_menu(cb: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("tdc_"))
 async def cb_test_dc_exec(cb: types.CallbackQuery):
     acc = cb.data.replace("tdc_", "")
-    if acc in accounts: accounts.pop(acc, None); await cb.answer(f"Тест: {acc} отключен!", show_alert=True)
-    await refresh_panels()
+    if acc in accounts: accounts.pop(acc, None); touch_fleets(acc); await cb.answer(f"Тест: {acc} отключен!", show_alert=True)
+    request_refresh()
 
 @dp.callback_query(F.data == "adm_broadcast")
 async def adm_bc(cb: types.CallbackQuery):
@@ -395,12 +1465,12 @@ async def show_bc_preview(m, state):
 async def bc_send(cb: types.CallbackQuery, state: FSMContext):
     d = await state.get_data(); text = f"<blockquote>{d['text']}</blockquote>"
     if d.get("has_title"): text = f"📢 <b>{d['title']}</b>\n\n{text}"
-    for cid in status_messages:
-        try:
-            if d.get("photo_id"): await bot.send_photo(cid, d["photo_id"], caption=text, parse_mode="HTML")
-            else: await bot.send_message(cid, text, parse_mode="HTML")
-        except: pass
-    await cb.message.answer("✅ Отправлено."); add_log("Админ сделал рассылку."); await state.clear()
+    chats = list(status_messages)
+    if d.get("photo_id"): delivery = send_to_chats(chats, PRIO_BROADCAST, "send_photo", photo=d["photo_id"], caption=text, parse_mode="HTML")
+    else: delivery = send_to_chats(chats, PRIO_BROADCAST, text=text, parse_mode="HTML")
+    await state.clear(); await cb.message.answer(f"⏳ Рассылка в очереди: {len(chats)} чатов.")
+    ok, bad = await delivery.wait()
+    await cb.message.answer(f"✅ Отправлено: <b>{ok}</b>, ошибок: <b>{bad}</b>.", parse_mode="HTML"); add_log(f"Админ сделал рассылку ({ok}/{len(chats)}).", "admin")
 
 @dp.callback_query(F.data == "bc_cancel")
 async def bc_cancel(cb: types.CallbackQuery, state: FSMContext): await state.clear(); await cb.message.delete()
@@ -412,12 +1482,12 @@ async def tech_root(cb: types.CallbackQuery):
     await cb.message.edit_reply_markup(reply_markup=kb)
 
 @dp.callback_query(F.data == "refresh_only")
-async def cb_refresh(cb: types.CallbackQuery): await refresh_panels(); await cb.answer("Обновлено!")
+async def cb_refresh(cb: types.CallbackQuery): request_refresh(); await cb.answer("Обновлено!")
 
 @dp.callback_query(F.data == "reset_session")
 async def cb_reset_s(cb: types.CallbackQuery):
-    global session_restarts; session_restarts = 0; initial_honey.clear(); disconnect_counts.clear()
-    add_log("Сброшена текущая сессия"); await save_data(); await refresh_panels(); await cb.answer("Сброшено")
+    global session_restarts; session_restarts = 0; initial_honey.clear(); disconnect_counts.clear(); rebuild_aggregates()
+    add_log("Сброшена текущая сессия", "admin"); mark_dirty("meta"); mark_dirty("init_h"); mark_dirty("dc_counts"); request_refresh(); await cb.answer("Сброшено")
 
 @dp.callback_query(F.data == "tp_menu")
 async def tp_menu(cb: types.CallbackQuery):
@@ -447,13 +1517,13 @@ async def tp_mode_fin(cb: types.CallbackQuery, state: FSMContext):
     is_auto = "auto" in cb.data; d = await state.get_data(); now = time.time()
     targets = list(notifications.keys()) if d['target'] == "all" else [d['target']]
     for t in targets: 
-        pause_data[t] = {"until": now + d['mins'] * 60, "auto_off": is_auto}
-        add_log(f"🛠 {t} ушел на паузу ({d['mins']}м)")
-    await save_data(); await state.clear(); await cb.message.answer(f"✅ Готово."); await refresh_panels()
+        pause_data[t] = {"until": now + d['mins'] * 60, "auto_off": is_auto}; mark_dirty("pause_data", t); schedule("pause", t, pause_data[t]["until"])
+        add_log(f"🛠 {t} ушел на паузу ({d['mins']}м)", "pause", t)
+    await state.clear(); await cb.message.answer(f"✅ Готово."); request_refresh()
 
 @dp.callback_query(F.data == "tp_clear_all")
 async def tp_clear(cb: types.CallbackQuery):
-    pause_data.clear(); add_log("🗑 Все паузы были сброшены вручную"); await save_data(); await cb.answer("Очищено"); await refresh_panels()
+    pause_data.clear(); add_log("🗑 Все паузы были сброшены вручную", "pause"); mark_dirty("pause_data"); await cb.answer("Очищено"); request_refresh()
 
 
 # --- Инлайн Режим ---
@@ -484,7 +1554,10 @@ async def inline_handler(query: InlineQuery):
         is_manual = len(args) > 0
         t_accs = args if is_manual else list(set(list(accounts.keys()) + list(pause_data.keys())))
         
-        if t_accs:
+        file_ids = image_memo.get(snapshot_key(build_snapshot(t_accs, not is_manual))) if t_accs else None
+        if file_ids:
+            results += [InlineQueryResultCachedPhoto(id=f"inline_img_{i}_{fid[-24:]}", photo_file_id=fid) for i, fid in enumerate(file_ids)]
+        elif t_accs:
             results.append(
                 InlineQueryResultArticle(
                     id="inline_img_trigger",
@@ -522,66 +1595,412 @@ async def cb_refresh_inline(cb: types.CallbackQuery):
 
 
 # --- Сервер и Мониторинг ---
+# Клиент может слать не весь payload: недостающие honey/pollen/capacity берутся из прошлого heartbeat,
+# а payload из одного username — keep-alive, который только продлевает жизнь аккаунту. Сырые значения
+# лежат в acc_stats (raw_h/raw_p/raw_c), который реплицируется, так что база общая для всех реплик.
+SIGNAL_FIELDS = ("honey", "pollen", "capacity")
+HB_MIN_INTERVAL = float(os.getenv("HB_MIN_INTERVAL", 5))
+HB_TARGET_RATE = float(os.getenv("HB_TARGET_RATE", 200))  # heartbeat'ов в секунду, выше которых просим клиентов реже
+class NeedFullPayload(ValueError):
+    """Дельта пришла, а достраивать не из чего: аккаунт не в сети или статистика старого формата. Клиент шлёт полный payload."""
+
+def _baseline(u):
+    """(мёд, пыльца, вместимость) из последнего heartbeat аккаунта, принятого любой репликой."""
+    st = acc_stats.get(u)
+    return (st["raw_h"], st["raw_p"], st["raw_c"]) if st and "raw_h" in st else None
+
+def next_heartbeat():
+    """Через сколько секунд клиенту слать следующий heartbeat: шестая часть check_timeout,
+    растянутая пропорционально перегрузке, но не реже трети таймаута — два пропуска переживём."""
+    load = heartbeat_meter.rate() / HB_TARGET_RATE
+    return round(min(check_timeout / 3, max(HB_MIN_INTERVAL, check_timeout / 6 * max(1, load))), 1)
+
+def apply_signal(d):
+    """Применяет один heartbeat к состоянию; на кривом payload бросает исключение, ничего не меняя."""
+    u = d.get("username")
+    if not u: raise ValueError("no username")
+    prev, keep_alive = _baseline(u), not any(k in d for k in SIGNAL_FIELDS)
+    if prev is None and not keep_alive and not all(k in d for k in SIGNAL_FIELDS): raise NeedFullPayload(u)
+    raw_honey, p, c = float(d.get("honey", prev[0] if prev else 0)), d.get("pollen", prev[1] if prev else 0), d.get("capacity", prev[2] if prev else 1)
+    raw_b = int((p/c)*100)
+    if u in pause_data and pause_data[u].get("auto_off"): 
+        pause_data.pop(u, None); mark_dirty("pause_data", u); add_log(f"✅ Пауза {u} снята автоматически", "pause", u)
+    
+    if u not in start_times: start_times[u] = time.time(); mark_dirty("starts", u); add_log(f"🟢 {u} вошел в сеть", "login", u); note_recovery(u)
+    last_seen = accounts.get(u); accounts[u] = time.time(); mark_dirty("accounts", u)
+    if ("acc", u) not in scheduled: schedule("acc", u, accounts[u] + check_timeout)
+    M_HEARTBEATS.inc(); heartbeat_meter.hit()
+    if keep_alive: return u
+
+    # Те же цифры, что в прошлый раз, — строки format_honey уже готовы
+    if prev != (raw_honey, p, c) or u not in acc_stats or u not in initial_honey:
+        if u not in initial_honey: initial_honey[u] = raw_honey; mark_dirty("init_h", u)
+        profit = raw_honey - initial_honey[u]
+        acc_stats[u] = {
+            "h": format_honey(raw_honey), "prof": format_honey(profit),
+            "raw_prof": profit, "b": f"{raw_b}%", "raw_b": raw_b, "raw_h": raw_honey, "raw_p": p, "raw_c": c
+        }
+        # Дневной итог — прирост к общей для всех реплик базе, и только если база из текущей онлайн-сессии,
+        # а не со времён до рестарта: пересекающихся интервалов между репликами так не бывает
+        if prev and raw_honey != prev[0] and last_seen and accounts[u] - last_seen <= check_timeout:
+            _add_daily("prof", u, raw_honey - prev[0])
+        mark_dirty("stats", u); track_profit(u)
+    record_sample(u, accounts[u], raw_honey, raw_b)
+    return u
+
+def _apply_item(i, d):
+    try: return {"i": i, "username": apply_signal(d), "ok": True}
+    except Exception as e:
+        M_HEARTBEAT_ERRORS.inc(reason=type(e).__name__)
+        res = {"i": i, "username": d.get("username") if isinstance(d, dict) else None, "ok": False, "error": type(e).__name__}
+        if isinstance(e, NeedFullPayload): res["need_full"] = True
+        return res
+
 async def handle_signal(request):
-    try:
-        d = await request.json(); u = d.get("username")
-        if u:
-            if u in pause_data and pause_data[u].get("auto_off"): 
-                pause_data.pop(u, None); add_log(f"✅ Пауза {u} снята автоматически")
-            
-            if u not in start_times: start_times[u] = time.time(); add_log(f"🟢 {u} вошел в сеть")
-            accounts[u] = time.time()
-            
-            raw_honey = float(d.get("honey", 0))
-            if u not in initial_honey: initial_honey[u] = raw_honey
-            profit = raw_honey - initial_honey[u]
-            
-            p, c = d.get("pollen", 0), d.get("capacity", 1)
-            raw_b = int((p/c)*100)
-            acc_stats[u] = {
-                "h": format_honey(raw_honey), "prof": format_honey(profit),
-                "raw_prof": profit, "b": f"{raw_b}%", "raw_b": raw_b
-            }
-            return web.Response(text="OK")
-    except: pass
-    return web.Response(status=400)
+    with M_SIGNAL_SECONDS.time(endpoint="signal"):
+        try:
+            d = await request.json(); apply_signal(d); nxt = next_heartbeat()
+            # Старые клиенты ждут текст "OK"; интервал им отдаём заголовком, новым (v=2) — ещё и в JSON
+            if d.get("v") == 2: return web.json_response({"ok": True, "next": nxt}, headers={"X-Next-Heartbeat": str(nxt)})
+            return web.Response(text="OK", headers={"X-Next-Heartbeat": str(nxt)})
+        except NeedFullPayload: M_HEARTBEAT_ERRORS.inc(reason="NeedFullPayload"); return web.json_response({"ok": False, "need_full": True}, status=409)
+        except Exception as e: M_HEARTBEAT_ERRORS.inc(reason=type(e).__name__)
+        return web.Response(status=400)
+
+async def handle_signal_batch(request):
+    """POST /signal/batch: JSON-массив payload'ов, ответ — результат по каждому элементу."""
+    with M_SIGNAL_SECONDS.time(endpoint="batch"):
+        try: items = await request.json()
+        except Exception as e: M_HEARTBEAT_ERRORS.inc(reason=type(e).__name__); return web.Response(status=400)
+        if isinstance(items, dict): items = items.get("items")
+        if not isinstance(items, list): return web.Response(status=400)
+        return web.json_response({"results": [_apply_item(i, d) for i, d in enumerate(items)], "next": next_heartbeat()})
+
+async def handle_signal_stream(request):
+    """POST /signal/stream: долгоживущий NDJSON-поток, по строке на heartbeat; результаты идут обратно тоже NDJSON."""
+    resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await resp.prepare(request)
+    i = 0
+    while line := await request.content.readline():
+        if not line.strip(): continue
+        try: res = _apply_item(i, json.loads(line))
+        except ValueError: M_HEARTBEAT_ERRORS.inc(reason="JSONDecodeError"); res = {"i": i, "ok": False, "error": "JSONDecodeError"}
+        if res["ok"]: res["next"] = next_heartbeat()
+        await resp.write((json.dumps(res) + "\n").encode()); i += 1
+    await resp.write_eof()
+    return resp
+
+# --- Дедлайны ---
+# Куча (момент, вид, ник): "acc" — аккаунт вылетит без heartbeat, "pause" — кончится пауза.
+# На каждый (вид, ник) в куче живёт одна актуальная запись: heartbeat её не трогает, а при
+# срабатывании запись сверяется с реальным состоянием и при необходимости переносится.
+deadlines, scheduled = [], {}
+deadline_event = asyncio.Event()
+PANEL_INTERVAL = 60
+
+def schedule(kind, u, when):
+    cur = scheduled.get((kind, u))
+    if cur is not None and cur <= when: return
+    scheduled[(kind, u)] = when; heapq.heappush(deadlines, (when, kind, u))
+    if deadlines[0][0] == when: deadline_event.set()
+
+def reschedule_all():
+    """Полная пересборка кучи — только при смене check_timeout и после загрузки состояния."""
+    deadlines.clear(); scheduled.clear()
+    for u, last in accounts.items(): schedule("acc", u, last + check_timeout)
+    for u, pd in pause_data.items(): schedule("pause", u, pd.get('until', 0))
+    if dc_buffer: schedule("storm", "", time.time())
+    if recovered: schedule("recover", "", time.time())
+    deadline_event.set()
+
+def _due_deadline(kind, u, now):
+    """Сверяет сработавшую запись с состоянием: True — дедлайн настоящий, иначе переносит или забывает."""
+    if kind in ("storm", "recover"): return True
+    if kind == "acc":
+        when = accounts[u] + check_timeout if u in accounts else None
+    else:
+        when = pause_data[u].get('until', 0) if u in pause_data else None
+    if when is None: return False
+    if when > now: schedule(kind, u, when); return False
+    return True
 
 async def check_timeouts():
-    now = time.time()
-    expired = [u for u, pd in pause_data.items() if now >= pd.get('until', 0)]
-    for u in expired: pause_data.pop(u, None); add_log(f"⏱ Время паузы {u} истекло")
-    
-    for u in list(accounts.keys()):
-        if now - accounts[u] > check_timeout:
-            if u not in pause_data:
-                tags = " ".join(notifications.get(u, ["!"]))
-                for cid in status_messages:
-                    try: await bot.send_message(cid, f"🚨 <b>{u}</b> ВЫЛЕТ!\n{tags}", parse_mode="HTML")
-                    except: pass
-                add_log(f"🔴 {u} вылетел")
-                disconnect_counts[u] = disconnect_counts.get(u, 0) + 1
-            accounts.pop(u, None); start_times.pop(u, None); acc_stats.pop(u, None)
-            
-    await save_data(); await refresh_panels()
+    """Обрабатывает только наступившие дедлайны; пустой тик — один взгляд на вершину кучи."""
+    now, changed = time.time(), False
+    while deadlines and deadlines[0][0] <= now:
+        when, kind, u = heapq.heappop(deadlines)
+        if scheduled.get((kind, u)) != when: continue
+        del scheduled[(kind, u)]
+        if not _due_deadline(kind, u, now): continue
+        changed = True
+        if kind == "storm": flush_disconnects(); continue
+        if kind == "recover": flush_recoveries(); continue
+        if kind == "pause":
+            pause_data.pop(u, None); mark_dirty("pause_data", u); add_log(f"⏱ Время паузы {u} истекло", "pause", u)
+            continue
+        if u not in pause_data and await claim_alert(u):
+            tags = " ".join(notifications.get(u, ["!"]))
+            note_disconnect(u, tags, now)
+            add_log(f"🔴 {u} вылетел", "disconnect", u)
+            disconnect_counts[u] = disconnect_counts.get(u, 0) + 1; mark_dirty("dc_counts", u)
+            track_disconnects(u); _add_daily("dc", u, 1)
+        accounts.pop(u, None); start_times.pop(u, None); acc_stats.pop(u, None); track_profit(u)
+        for d in ("accounts", "starts", "stats"): mark_dirty(d, u)
+    if changed: request_refresh()
+
+# --- Массовые вылеты ---
+# Рестарт сервера Roblox или обрыв сети фермы роняет все аккаунты за пару секунд. Одиночные вылеты
+# уходят сразу, как и раньше. Вылеты, идущие подряд с паузами меньше STORM_WINDOW, считаются; начиная
+# с STORM_MIN-го это шторм: остальные копятся STORM_WINDOW секунд, и каждый чат получает одну сводку
+# по своим аккаунтам вместо пачки «ВЫЛЕТ!», а по возвращении — такую же сводку «вернулись».
+STORM_WINDOW = float(os.getenv("STORM_WINDOW", 10))  # 0 — слать алерты сразу, по одному
+STORM_MIN = int(os.getenv("STORM_MIN", 3))
+STORM_TTL = 6 * 3600     # сколько ждать возвращения аккаунтов из сводки
+DIGEST_LINES = 40        # дальше — «…и ещё N», чтобы не упереться в 4096 символов
+dc_buffer = {}           # ник -> теги: вылеты шторма, ждущие сводки
+storm_head = []          # ники, уже оповещённые по одному в текущей серии вылетов
+storm_count, storm_last = 0, 0.0  # длина текущей серии и время последнего вылета в ней
+storm_open = {}          # ник -> когда попал в сводку вылета; ждём его обратно
+recovered = []           # вернувшиеся из storm_open, ждущие своей сводки
+
+def _by_chat(accs):
+    chats = {}
+    for u in accs:
+        for cid in chats_following(u): chats.setdefault(cid, []).append(u)
+    return chats
+
+def _digest(title, lines):
+    extra = f"\n…и ещё {len(lines) - DIGEST_LINES}" if len(lines) > DIGEST_LINES else ""
+    return f"{title}\n\n" + "\n".join(lines[:DIGEST_LINES]) + extra
+
+def _expire_storms(now):
+    for u in [u for u, t in storm_open.items() if now - t > STORM_TTL]: del storm_open[u]
+
+def note_disconnect(u, tags, now):
+    """Первые STORM_MIN-1 вылетов серии — обычные алерты без задержки, дальше — в сводку шторма."""
+    global storm_count, storm_last
+    if now - storm_last > STORM_WINDOW: storm_count = 0; storm_head.clear()
+    storm_count += 1; storm_last = now
+    if STORM_WINDOW <= 0 or storm_count < STORM_MIN:
+        storm_head.append(u)
+        send_to_chats(chats_following(u), PRIO_ALERT, text=f"🚨 <b>{u}</b> ВЫЛЕТ!\n{tags}", parse_mode="HTML")
+        return
+    if storm_head:  # шторм начался: оповещённых по одному тоже ждём обратно для сводки «вернулись»
+        for v in storm_head: storm_open[v] = now
+        storm_head.clear()
+    if not dc_buffer: schedule("storm", "", now + STORM_WINDOW)
+    dc_buffer[u] = tags
+
+def flush_disconnects():
+    """Сводка накопленных вылетов шторма в каждый затронутый чат."""
+    batch, now = dict(dc_buffer), time.time(); dc_buffer.clear(); _expire_storms(now)
+    if not batch: return
+    add_log(f"🌩 Массовый вылет: {len(batch)} акк.", "disconnect")
+    for u in batch: storm_open[u] = now
+    for cid, accs in _by_chat(batch).items():
+        text = _digest(f"🌩 <b>МАССОВЫЙ ВЫЛЕТ</b>: {len(accs)} акк.", [f"🔴 <b>{u}</b> {batch[u]}" for u in accs])
+        send_to_chats([cid], PRIO_ALERT, text=text, parse_mode="HTML")
+
+def note_recovery(u):
+    """Аккаунт из сводки вылета снова в сети; вернувшиеся за окно уходят одной сводкой."""
+    if storm_open.pop(u, None) is None: return
+    if not recovered: schedule("recover", "", time.time() + STORM_WINDOW)
+    recovered.append(u)
+
+def flush_recoveries():
+    batch = recovered[:]; recovered.clear(); _expire_storms(time.time())
+    add_log(f"✅ Вернулись после вылета: {len(batch)} акк.", "login")
+    for cid, accs in _by_chat(batch).items():
+        waiting = f"\n\n⏳ Ещё не вернулись: {len(storm_open)}" if storm_open else ""
+        text = _digest(f"✅ <b>ВЕРНУЛИСЬ</b>: {len(accs)} акк.", [f"🟢 <b>{u}</b>" for u in accs]) + waiting
+        send_to_chats([cid], PRIO_ALERT, text=text, parse_mode="HTML")
+
+# --- Панели статуса ---
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше burst про запас."""
+    def __init__(self, rate, burst):
+        self.rate, self.burst, self.tokens, self.ts = rate, burst, burst, time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate); self.ts = now
+            if self.tokens >= 1: self.tokens -= 1; return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+TG_GLOBAL_RATE = 25     # Telegram: ~30 запросов в секунду на бота, оставляем запас
+TG_CHAT_INTERVAL = 1.0  # и не чаще раза в секунду в личку
+TG_GROUP_INTERVAL = 3.0 # в группы (id < 0) — ~20 сообщений в минуту
+PANEL_COALESCE = 1.0
+tg_bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+chat_ready = {}         # чат -> когда в него снова можно писать
+panel_hashes = {}       # чат -> хэш последнего отправленного в панель текста
+panel_event = asyncio.Event()
+panel_sem = asyncio.Semaphore(16)
+
+async def chat_slot(cid):
+    """Ждёт и общий лимит бота, и лимит конкретного чата."""
+    now = time.monotonic(); ready = chat_ready.get(cid, 0)
+    chat_ready[cid] = max(now, ready) + (TG_GROUP_INTERVAL if int(cid) < 0 else TG_CHAT_INTERVAL)
+    if ready > now: await asyncio.sleep(ready - now)
+    await tg_bucket.acquire()
+
+def request_refresh():
+    """Просит обновить панели; всплеск запросов за PANEL_COALESCE сливается в один проход."""
+    panel_event.set()
+
+async def _edit_panel(cid, mid, txt, h, kb):
+    async with panel_sem:
+        await chat_slot(cid)
+        try: await bot.edit_message_text(txt, chat_id=int(cid), message_id=int(mid), parse_mode="HTML", reply_markup=kb)
+        except Exception as e:
+            if "is not modified" not in str(e).lower(): return
+        panel_hashes[cid] = h
 
 async def refresh_panels():
-    txt = get_status_text(); kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⚙️ Настройки", callback_data="ask_reset")]])
-    for cid, mid in list(status_messages.items()):
-        try: await bot.edit_message_text(txt, chat_id=int(cid), message_id=int(mid), parse_mode="HTML", reply_markup=kb)
-        except: pass
+    """Текст собирается раз на флот, правятся только панели, чей флот действительно поменялся."""
+    kb, edits = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⚙️ Настройки", callback_data="ask_reset")]]), []
+    for key, chats in list(fleet_chats.items()):
+        targets = [cid for cid in chats if cid in status_messages]
+        if not targets: continue
+        body, h = fleet_body(key)
+        targets = [cid for cid in targets if panel_hashes.get(cid) != h]
+        if targets:
+            txt = get_status_text(body)
+            edits += [_edit_panel(cid, status_messages[cid], txt, h, kb) for cid in targets]
+    if edits: await asyncio.gather(*edits)
+
+async def panel_refresher():
+    while True:
+        await panel_event.wait(); await asyncio.sleep(PANEL_COALESCE); panel_event.clear()
+        if not is_leader: continue
+        try: await refresh_panels()
+        except Exception: swallowed("refresh_panels")
+
+# --- Очередь исходящих ---
+PRIO_ALERT, PRIO_BROADCAST = 0, 1
+OUTBOX_WORKERS, OUTBOX_RETRIES = 8, 4
+outbox = asyncio.PriorityQueue()
+outbox_seq = itertools.count()
+
+class Delivery:
+    """Итоги доставки одной пачки: сколько дошло, сколько нет."""
+    def __init__(self, total):
+        self.total, self.delivered, self.failed, self.done = total, 0, 0, asyncio.Event()
+        if not total: self.done.set()
+
+    def settle(self, ok):
+        if ok: self.delivered += 1
+        else: self.failed += 1
+        if self.delivered + self.failed >= self.total: self.done.set()
+
+    async def wait(self):
+        await self.done.wait(); return self.delivered, self.failed
+
+def send_to_chats(chats, prio, method="send_message", **kwargs):
+    """Ставит сообщение в очередь для каждого чата; алерты обгоняют рассылки."""
+    delivery = Delivery(len(chats))
+    for cid in chats: outbox.put_nowait((prio, next(outbox_seq), cid, method, kwargs, delivery))
+    return delivery
+
+async def _deliver(cid, method, kwargs):
+    for attempt in range(OUTBOX_RETRIES):
+        await chat_slot(cid)
+        try: await getattr(bot, method)(chat_id=cid, **kwargs); return True
+        except TelegramRetryAfter as e:
+            chat_ready[cid] = time.monotonic() + e.retry_after; await asyncio.sleep(e.retry_after)
+        except (TelegramNetworkError, TelegramServerError): await asyncio.sleep(2 ** attempt)
+        except Exception: swallowed("outbox_deliver"); return False
+    return False
+
+async def outbox_worker():
+    while True:
+        _, _, cid, method, kwargs, delivery = await outbox.get()
+        try: delivery.settle(await _deliver(cid, method, kwargs))
+        except Exception: swallowed("outbox_worker"); delivery.settle(False)
+        outbox.task_done()
 
 async def monitor_loop():
-    add_log("🚀 Сервер мониторинга запущен")
+    add_log("🚀 Сервер мониторинга запущен"); reschedule_all()
     while True:
-        try: await check_timeouts()
-        except: pass
-        await asyncio.sleep(30)
+        if not is_leader: await asyncio.sleep(1); continue
+        deadline_event.clear()
+        try:
+            with M_TIMEOUTS_SECONDS.time(): await check_timeouts()
+        except Exception: swallowed("check_timeouts")
+        delay = deadlines[0][0] - time.time() if deadlines else PANEL_INTERVAL
+        try: await asyncio.wait_for(deadline_event.wait(), timeout=max(0, delay))
+        except asyncio.TimeoutError: pass
+
+async def panel_loop():
+    """Плановое обновление панелей: тикает время онлайна."""
+    while True: await asyncio.sleep(PANEL_INTERVAL); request_refresh()
+
+# --- Webhook ---
+# WEBHOOK_URL задан — апдейты приходят POST'ом на тот же aiohttp-сервер, что и /signal; иначе long polling.
+# Секрет по умолчанию выводится из токена, чтобы все реплики проверяли один и тот же заголовок.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()[:48]
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", 32))
+update_slots = asyncio.Semaphore(WEBHOOK_CONCURRENCY)
+update_tasks = set()
+
+async def _process_update(update):
+    try: await dp.feed_update(bot, update)
+    except Exception: swallowed("webhook_update")
+    finally: update_slots.release()
+
+async def handle_webhook(request):
+    """Отвечает Telegram сразу, а апдейт обрабатывает в фоне. Если занято больше WEBHOOK_CONCURRENCY
+    слотов, ответ придерживается — Telegram сам притормозит доставку."""
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET: return web.Response(status=401)
+    try: update = types.Update.model_validate(await request.json(), context={"bot": bot})
+    except Exception: swallowed("webhook_parse"); return web.Response(status=400)
+    await update_slots.acquire()
+    task = asyncio.create_task(_process_update(update))
+    update_tasks.add(task); task.add_done_callback(update_tasks.discard)
+    return web.Response()
+
+# --- Старт и здоровье ---
+readiness = {"fonts": False, "state": False, "backgrounds": False}
+
+async def warm_fonts():
+    await download_font(); readiness["fonts"] = os.path.exists(FONT_PATH)
+
+async def warm_state():
+    readiness["state"] = await load_data()
+
+async def warm_backgrounds():
+    await asyncio.gather(*(warm_background(src) for src in ([active_bg] if active_bg else BG_URLS)))
+    readiness["backgrounds"] = True
+
+async def handle_health(request):
+    ready = readiness["state"]
+    body = {"ready": ready, "components": readiness, "leader": is_leader, "version": VERSION}
+    return web.json_response(body, status=200 if ready else 503)
+
+def build_app():
+    app = web.Application(middlewares=[http_timing]); app.router.add_post('/signal', handle_signal)
+    app.router.add_post('/signal/batch', handle_signal_batch); app.router.add_post('/signal/stream', handle_signal_stream)
+    app.router.add_get('/metrics', handle_metrics); app.router.add_get('/health', handle_health); app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    return app
 
 async def main():
-    await download_font(); await load_data()
-    asyncio.create_task(monitor_loop())
-    app = web.Application(); app.router.add_post('/signal', handle_signal)
-    runner = web.AppRunner(app); await runner.setup(); await web.TCPSite(runner, '0.0.0.0', PORT).start()
-    await bot.delete_webhook(drop_pending_updates=True); await dp.start_polling(bot)
+    # Сначала приём heartbeat'ов, чтобы долгий CDN или Redis после деплоя не порождали ложные вылеты
+    runner = web.AppRunner(build_app()); await runner.setup(); await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    spawn(loop_watchdog()); spawn(warm_fonts()); await warm_state(); spawn(warm_backgrounds())
+    spawn(monitor_loop()); spawn(panel_loop()); spawn(panel_refresher()); spawn(save_loop())
+    for _ in range(OUTBOX_WORKERS): spawn(outbox_worker())
+    if SHARED_STATE and db: spawn(replica_listener()); spawn(leader_loop())
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=dp.resolve_used_update_types(), drop_pending_updates=True)
+            await asyncio.Event().wait()
+        await bot.delete_webhook(drop_pending_updates=True)
+        if SHARED_STATE and db: await poll_while_leader()
+        else: await dp.start_polling(bot)
+    finally: await save_data()
 
 if __name__ == "__main__": asyncio.run(main())